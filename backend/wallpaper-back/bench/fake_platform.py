@@ -0,0 +1,97 @@
+# Plataforma falsa para rodar o agente fora do Windows (benchmark / CI Linux).
+# Substitui server.PLATFORM: Registro em memória, SPI sem efeito e saídas
+# enlatadas de wmic/getmac/shutdown.
+import subprocess, threading, time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class FakeWinreg:
+    """Subconjunto do módulo `winreg` usado pelo agente, guardado em dicionários."""
+    HKEY_CURRENT_USER = 0x80000001
+    HKEY_LOCAL_MACHINE = 0x80000002
+    KEY_READ = 0x20019
+    KEY_WOW64_64KEY = 0x0100
+    REG_SZ = 1
+    REG_DWORD = 4
+
+    class _Key:
+        def __init__(self, values: Dict[str, Tuple[Any, int]]):
+            self.values = values
+        def Close(self):
+            pass
+
+    def __init__(self, write_latency: float = 0.0):
+        self._lock = threading.Lock()
+        self._keys: Dict[Tuple[int, str], Dict[str, Tuple[Any, int]]] = {}
+        self.write_latency = write_latency
+        self.writes = 0
+        self.set(self.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Cryptography", "MachineGuid", "bench-0000-guid")
+
+    def set(self, hive: int, path: str, name: str, value: Any, typ: int = REG_SZ):
+        with self._lock:
+            self._keys.setdefault((hive, path.lower()), {})[name] = (value, typ)
+
+    def OpenKey(self, hive: int, path: str, reserved: int = 0, access: int = 0):
+        with self._lock:
+            vals = self._keys.get((hive, path.lower()))
+        if vals is None:
+            raise FileNotFoundError(path)
+        return FakeWinreg._Key(vals)
+
+    def CreateKey(self, hive: int, path: str):
+        with self._lock:
+            return FakeWinreg._Key(self._keys.setdefault((hive, path.lower()), {}))
+
+    def QueryValueEx(self, key: "_Key", name: str):
+        with self._lock:
+            if name not in key.values:
+                raise FileNotFoundError(name)
+            return key.values[name]
+
+    def SetValueEx(self, key: "_Key", name: str, reserved: int, typ: int, value: Any):
+        if self.write_latency: time.sleep(self.write_latency)
+        with self._lock:
+            key.values[name] = (value, typ)
+            self.writes += 1
+
+
+WMIC_BASEBOARD = "Node,Manufacturer,Product,SerialNumber\r\nBENCH,ASUSTeK COMPUTER INC.,PRIME H310M-E,190512345678\r\n"
+WMIC_CPU = "Node,Name,NumberOfCores,NumberOfLogicalProcessors\r\nBENCH,Intel(R) Core(TM) i3-3210 CPU @ 3.20GHz,2,4\r\n"
+GETMAC = ('"Connection Name","Network Adapter","Physical Address","Transport Name"\r\n'
+          '"Ethernet","Realtek PCIe GbE Family Controller","D8-BB-C1-12-34-56","\\Device\\Tcpip_{0000}"\r\n'
+          '"Wi-Fi","Intel(R) Wireless-AC 9560","N/A","Media disconnected"\r\n')
+
+
+class FakePlatform:
+    """Mesma interface de server.WindowsPlatform. `cmd_latency`/`spi_latency` simulam
+    o custo de processo/SPI reais para que o benchmark não fique otimista demais."""
+    def __init__(self, cmd_latency: float = 0.0, spi_latency: float = 0.0, reg_latency: float = 0.0):
+        self.reg = FakeWinreg(write_latency=reg_latency)
+        self.cmd_latency = cmd_latency
+        self.spi_latency = spi_latency
+        self.calls: Dict[str, int] = {"spi": 0, "run": 0}
+
+    def winreg(self):
+        return self.reg
+
+    def spi(self, action: int, param: int, value, flags: int) -> int:
+        self.calls["spi"] += 1
+        if self.spi_latency: time.sleep(self.spi_latency)
+        return 1
+
+    def last_error(self) -> int:
+        return 0
+
+    def run(self, args: List[str], timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        self.calls["run"] += 1
+        if self.cmd_latency: time.sleep(self.cmd_latency)
+        out = {"baseboard": WMIC_BASEBOARD, "cpu": WMIC_CPU}.get(args[1] if len(args) > 1 else "", "")
+        if args[0] == "getmac": out = GETMAC
+        return subprocess.CompletedProcess(args, 0, stdout=out, stderr="")
+
+    def memory_status(self) -> Tuple[int, float]:
+        return 8 * 1024**3, 42.0
+
+    def system_times(self) -> Optional[Tuple[float, float]]:
+        t = time.perf_counter()
+        return t * 0.7, t
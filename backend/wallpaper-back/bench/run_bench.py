@@ -0,0 +1,308 @@
+"""Benchmark reproduzível do Wallpaper Agent (server.py), rodando fora do Windows.
+
+A API do agente é exercitada em processo (ASGI via httpx) com `server.PLATFORM`
+trocado por bench/fake_platform.py (Registro em memória, SPI sem efeito, saídas
+enlatadas de wmic/getmac). O Mongo pode ser um mongod local ou o mongomock.
+
+Uso (a partir de backend/wallpaper-back):
+    pip install -r requirements.txt -r bench/requirements.txt
+    python bench/run_bench.py                                   # mongomock em processo
+    python bench/run_bench.py --mongo-uri mongodb://localhost:27017 --out bench/results/$(git rev-parse --short HEAD).json
+    python bench/run_bench.py --only status,serve
+    python bench/run_bench.py --compare bench/results/base.json bench/results/novo.json
+
+Cenários: status (polling concorrente de /obter_status), upload_new / upload_repeat /
+upload_burst (/alterar_papel_de_parede: imagem nova, reaplicação e rajada concorrente),
+serve (/wallpaper/{id}), hosts_block / hosts_unblock / hosts_list (hosts grande) e
+cleanup (clean_old_wallpapers com backlog). Cada cenário gera ops/s e latências
+p50/p90/p99/max em ms; o JSON de saída é estável para comparação entre commits.
+"""
+import os, io, sys, json, time, random, asyncio, argparse, datetime, logging, platform, subprocess, tempfile
+from typing import Any, Callable, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AGENT_DIR = os.path.dirname(HERE)
+SCENARIOS = ["status", "upload_new", "upload_repeat", "upload_burst", "serve",
+             "hosts_block", "hosts_unblock", "hosts_list", "encoding_status", "encoding_blocked",
+             "cleanup", "storage_report", "phash_lookup"]
+
+# ---------- estatística ----------
+
+def _pct(sorted_vals: List[float], p: float) -> float:
+    if not sorted_vals: return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+def _summary(lat: List[float], wall: float, errors: int = 0, **extra) -> Dict[str, Any]:
+    v = sorted(x * 1000.0 for x in lat)
+    out = {
+        "n": len(lat), "errors": errors, "wall_s": round(wall, 4),
+        "ops_per_s": round(len(lat) / wall, 2) if wall > 0 else None,
+        "p50_ms": round(_pct(v, 50), 3), "p90_ms": round(_pct(v, 90), 3),
+        "p99_ms": round(_pct(v, 99), 3), "max_ms": round(v[-1], 3) if v else 0.0,
+    }
+    out.update(extra)
+    return out
+
+async def _measure_async(n: int, concurrency: int, op: Callable[[int], Any], **extra) -> Dict[str, Any]:
+    lat: List[float] = []; errors = 0
+    sem = asyncio.Semaphore(concurrency)
+    async def one(i: int):
+        nonlocal errors
+        async with sem:
+            t = time.perf_counter()
+            try: await op(i)
+            except Exception: errors += 1
+            lat.append(time.perf_counter() - t)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    return _summary(lat, time.perf_counter() - t0, errors, concurrency=concurrency, **extra)
+
+def _measure_sync(n: int, op: Callable[[int], Any], setup: Callable[[int], Any] = None, **extra) -> Dict[str, Any]:
+    lat: List[float] = []; errors = 0; busy = 0.0
+    for i in range(n):
+        if setup: setup(i)  # fora da medição
+        t = time.perf_counter()
+        try: op(i)
+        except Exception: errors += 1
+        dt = time.perf_counter() - t; lat.append(dt); busy += dt
+    return _summary(lat, busy, errors, **extra)
+
+# ---------- agente ----------
+
+def load_agent(args, workdir: str):
+    """Importa server.py com ambiente isolado (APPDATA/PROGRAMDATA temporários) e plataforma falsa."""
+    os.environ["APPDATA"] = os.path.join(workdir, "appdata")
+    os.environ["PROGRAMDATA"] = os.path.join(workdir, "programdata")
+    os.environ["DB_NAME"] = args.db_name
+    os.environ["MONGO_URI"] = args.mongo_uri or "mongodb://mongomock"
+    os.chdir(workdir)  # não herdar um .env do diretório do agente
+    if not args.mongo_uri:
+        import mongomock, mongomock.gridfs, pymongo
+        mongomock.gridfs.enable_gridfs_integration()
+        pymongo.MongoClient = mongomock.MongoClient
+    sys.path.insert(0, AGENT_DIR)
+    import server
+    from fake_platform import FakePlatform
+    server.logger.setLevel(logging.WARNING)
+    server.PLATFORM = FakePlatform(cmd_latency=args.cmd_latency, spi_latency=args.spi_latency)
+    server.HOSTS_PATH = os.path.join(workdir, "hosts")
+    return server
+
+def _image(seed: int, size, fmt: str = "JPEG") -> bytes:
+    from PIL import Image
+    w, h = size
+    rnd = random.Random(seed)
+    im = Image.frombytes("RGB", (w // 8, h // 8), rnd.randbytes((w // 8) * (h // 8) * 3)).resize((w, h))
+    buf = io.BytesIO(); im.save(buf, format=fmt, quality=88); return buf.getvalue()
+
+def _hosts_file(path: str, lines: int):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("# hosts de benchmark\n127.0.0.1 localhost\n")
+        for i in range(lines):
+            f.write(f"127.0.0.1 bloqueado-{i}.exemplo.com\n")
+
+async def run(args) -> Dict[str, Any]:
+    import httpx
+    workdir = tempfile.mkdtemp(prefix="wpbench-")
+    server = load_agent(args, workdir)
+    key = {"x_agent_key": server.S.AGENT_KEY} if server.S.AGENT_KEY else {}
+    size = tuple(int(x) for x in args.image_size.lower().split("x"))
+    only = set(args.only.split(",")) if args.only else set(SCENARIOS)
+    res: Dict[str, Any] = {}
+    file_ids: List[str] = []
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://agent", timeout=120) as c:
+        async def ok(resp):
+            if resp.status_code >= 400: raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+            return resp
+
+        async def upload(data: bytes, name: str, estilo: str = "preencher"):
+            r = await ok(await c.post("/alterar_papel_de_parede", params=key,
+                                      files={"file": (name, data, "image/jpeg")}, data={"estilo": estilo}))
+            body = r.json()
+            if body.get("file_id"): file_ids.append(body["file_id"])
+            return body
+
+        if "status" in only:
+            async def op(i): await ok(await c.get("/obter_status"))
+            res["status"] = await _measure_async(args.requests, args.concurrency, op)
+
+        imgs = [_image(args.seed + i, size) for i in range(args.uploads)]
+        if "upload_new" in only or "serve" in only:
+            async def op(i): await upload(imgs[i], f"bench-{i}.jpg")
+            r = await _measure_async(len(imgs), 1, op, bytes_per_image=sum(map(len, imgs)) // len(imgs))
+            if "upload_new" in only: res["upload_new"] = r
+
+        if "upload_repeat" in only:
+            await upload(imgs[0], "bench-0.jpg")  # garante que é a imagem ativa
+            async def op(i): await upload(imgs[0], "bench-0.jpg")
+            res["upload_repeat"] = await _measure_async(args.uploads, 1, op)
+
+        if "upload_burst" in only:
+            outcomes: Dict[str, int] = {}
+            async def op(i):
+                body = await upload(imgs[i % len(imgs)], f"burst-{i}.jpg", "ajustar" if i % 2 else "preencher")
+                outcomes[body.get("status", "?")] = outcomes.get(body.get("status", "?"), 0) + 1
+            res["upload_burst"] = await _measure_async(args.uploads, args.concurrency, op)
+            res["upload_burst"]["outcomes"] = outcomes
+
+        if "serve" in only and file_ids:
+            ids = sorted(set(file_ids))
+            async def op(i): await ok(await c.get(f"/wallpaper/{ids[i % len(ids)]}"))
+            res["serve"] = await _measure_async(args.requests, args.concurrency, op, distinct_ids=len(ids))
+
+        sites = [f"novo-{i}.exemplo.com" for i in range(args.hosts_batch)]
+        present = [f"bloqueado-{i}.exemplo.com" for i in range(0, args.hosts_lines, max(1, args.hosts_lines // args.hosts_batch))][:args.hosts_batch]
+        for name, path, body in (("hosts_block", "/block_sites", sites), ("hosts_unblock", "/unblock_sites", present)):
+            if name not in only: continue
+            lat: List[float] = []
+            for _ in range(args.repeat):
+                _hosts_file(server.HOSTS_PATH, args.hosts_lines)
+                t = time.perf_counter()
+                await ok(await c.post(path, params=key, json={"websites": body}))
+                lat.append(time.perf_counter() - t)
+            res[name] = _summary(lat, sum(lat), hosts_lines=args.hosts_lines, batch=len(body))
+        if "hosts_list" in only:
+            _hosts_file(server.HOSTS_PATH, args.hosts_lines)
+            async def op(i): await ok(await c.get("/blocked_sites", params=key))
+            res["hosts_list"] = await _measure_async(args.repeat, 1, op, hosts_lines=args.hosts_lines)
+
+        # bytes na rede x latência por representação; a linha principal (p50) é JSON+gzip,
+        # o que um navegador recebe sem pedir nada de especial
+        variants = {
+            "json": {"Accept-Encoding": "identity"},
+            "gzip": {"Accept-Encoding": "gzip"},
+            "br": {"Accept-Encoding": "br"},
+            "msgpack": {"Accept-Encoding": "identity", "Accept": "application/msgpack"},
+            "msgpack_br": {"Accept-Encoding": "br", "Accept": "application/msgpack"},
+        }
+        for name, path, n, fields in (("encoding_status", "/obter_status", args.requests, "status,wallpaper.file_id,mongo_connected"),
+                                      ("encoding_blocked", "/blocked_sites", args.repeat * 4, "count")):
+            if name not in only: continue
+            if name == "encoding_blocked": _hosts_file(server.HOSTS_PATH, args.hosts_lines)
+            table: Dict[str, Any] = {}
+            for label, headers in {**variants, "fields": {"Accept-Encoding": "gzip"}}.items():
+                params = {**key, **({"fields": fields} if label == "fields" else {})}
+                sizes: List[int] = []
+                async def op(i):
+                    r = await ok(await c.get(path, params=params, headers=headers))
+                    sizes.append(r.num_bytes_downloaded)
+                table[label] = await _measure_async(n, 1, op)
+                table[label]["bytes"] = sizes[-1] if sizes else None
+            res[name] = {**table["gzip"], "variants": {k: {"bytes": v["bytes"], "p50_ms": v["p50_ms"]} for k, v in table.items()}}
+
+    old = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=server.S.DAYS_TO_KEEP + 5)
+    files = server.DBI.client[args.db_name][f"{server.S.WALLPAPER_COLLECTION}.files"]
+    def fill(_, mixed: bool = False):
+        # mixed: metade nunca aplicada (lastUsedAt null), que a limpeza não remove
+        ids = [server.DBI.fs.put(b"x" * 512, filename=f"old-{i}.jpg",
+                                 metadata={"sha256": None, "bytes": 512, "uploadedAt": old,
+                                           "lastUsedAt": None if mixed and i % 2 else old})
+               for i in range(args.backlog)]
+        # o GridFS grava uploadDate = agora; envelhece depois
+        files.update_many({"_id": {"$in": ids}}, {"$set": {"uploadDate": old}})
+        return ids
+
+    if "storage_report" in only:
+        ids = fill(0, mixed=True)
+        def op(_): server.STORAGE_REPORT.get(refresh=True)
+        res["storage_report"] = _measure_sync(args.repeat, op, backlog=args.backlog)
+        t = time.perf_counter(); server.STORAGE_REPORT.get()
+        res["storage_report"]["cached_ms"] = round((time.perf_counter() - t) * 1000, 3)
+        res["storage_report"]["reclaimable"] = server.STORAGE_REPORT.get()["reclaimable"]
+        for i in ids: server.DBI.fs.delete(i)
+
+    if "cleanup" in only:
+        def op(_): server.clean_old_wallpapers()
+        res["cleanup"] = _measure_sync(args.repeat, op, setup=fill, backlog=args.backlog)
+        res["cleanup"]["left_behind"] = files.count_documents({"uploadDate": {"$lt": old + datetime.timedelta(seconds=1)}})
+
+    if "phash_lookup" in only:
+        # só o índice em memória: N hashes aleatórios, consultas com alguns bits trocados
+        rnd = random.Random(args.seed)
+        index = server.HammingIndex()
+        hashes = [rnd.getrandbits(64) for _ in range(args.index_size)]
+        t0 = time.perf_counter()
+        for i, h in enumerate(hashes): index.add(h, str(i))
+        build_s = time.perf_counter() - t0
+        def op(i):
+            h = hashes[rnd.randrange(len(hashes))]
+            for b in rnd.sample(range(64), rnd.randint(0, server.S.PHASH_MAX_DISTANCE)): h ^= 1 << b
+            if not index.search(h, server.S.PHASH_MAX_DISTANCE): raise LookupError("não achou")
+        res["phash_lookup"] = _measure_sync(args.requests, op, index_size=args.index_size, build_s=round(build_s, 3))
+
+    try: server.DBI.client.drop_database(args.db_name)
+    except Exception: pass
+    res["platform_calls"] = dict(server.PLATFORM.calls)
+    return res
+
+# ---------- saída / comparação ----------
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=AGENT_DIR, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(base_path: str, new_path: str, threshold: float) -> int:
+    base = json.load(open(base_path, encoding="utf-8"))["results"]
+    new = json.load(open(new_path, encoding="utf-8"))["results"]
+    worse = 0
+    print(f"{'cenário':<16}{'p50 base':>10}{'p50 novo':>10}{'Δ p50':>9}{'p99 base':>10}{'p99 novo':>10}{'Δ p99':>9}")
+    for name in SCENARIOS:
+        if name not in base or name not in new: continue
+        b, n = base[name], new[name]
+        d50 = (n["p50_ms"] - b["p50_ms"]) / b["p50_ms"] if b["p50_ms"] else 0.0
+        d99 = (n["p99_ms"] - b["p99_ms"]) / b["p99_ms"] if b["p99_ms"] else 0.0
+        flag = "  <- regressão" if d50 > threshold else ""
+        worse += bool(flag)
+        print(f"{name:<16}{b['p50_ms']:>10.2f}{n['p50_ms']:>10.2f}{d50:>+9.0%}{b['p99_ms']:>10.2f}{n['p99_ms']:>10.2f}{d99:>+9.0%}{flag}")
+    return 1 if worse else 0
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark do Wallpaper Agent")
+    ap.add_argument("--mongo-uri", help="mongod real (ex.: mongodb://localhost:27017); padrão: mongomock em processo")
+    ap.add_argument("--db-name", default=f"wallpaper_bench_{os.getpid()}")
+    ap.add_argument("--only", help="lista de cenários separados por vírgula: " + ",".join(SCENARIOS))
+    ap.add_argument("--requests", type=int, default=200, help="requisições nos cenários de leitura")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--uploads", type=int, default=12)
+    ap.add_argument("--image-size", default="1920x1080")
+    ap.add_argument("--hosts-lines", type=int, default=20000)
+    ap.add_argument("--hosts-batch", type=int, default=1000)
+    ap.add_argument("--backlog", type=int, default=500, help="arquivos antigos nos cenários cleanup/storage_report")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--index-size", type=int, default=100000, help="hashes no cenário phash_lookup")
+    ap.add_argument("--seed", type=int, default=1234)
+    ap.add_argument("--cmd-latency", type=float, default=0.05, help="latência simulada de wmic/getmac (s)")
+    ap.add_argument("--spi-latency", type=float, default=0.02, help="latência simulada do SPI (s)")
+    ap.add_argument("--out", help="grava o JSON neste caminho (padrão: stdout)")
+    ap.add_argument("--compare", nargs=2, metavar=("BASE", "NOVO"), help="compara dois resultados e sai")
+    ap.add_argument("--threshold", type=float, default=0.10, help="piora relativa de p50 que conta como regressão")
+    args = ap.parse_args()
+
+    if args.compare:
+        sys.exit(compare(args.compare[0], args.compare[1], args.threshold))
+
+    if args.out: args.out = os.path.abspath(args.out)  # load_agent muda o cwd
+    started = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    results = asyncio.run(run(args))
+    doc = {
+        "meta": {
+            "commit": _git_commit(), "started_at": started, "python": platform.python_version(),
+            "platform": platform.platform(), "mongo": "mongod" if args.mongo_uri else "mongomock",
+            "params": {k: v for k, v in vars(args).items() if k not in ("compare", "out", "mongo_uri")},
+        },
+        "results": results,
+    }
+    text = json.dumps(doc, ensure_ascii=False, indent=2)
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f: f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# Motor do arquivo hosts compartilhado pelo agente (server.py) e pelo website_blocker.py.
+# O arquivo é lido e interpretado uma vez, as mudanças são diferenças de conjunto
+# (nada de `entry in content` por site) e a gravação é um único commit atômico.
+import os, re, stat, tempfile, threading
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+IP_REDIRECT = "127.0.0.1"
+
+# progress(etapa, feitos, total) — chamado fora da thread da interface
+Progress = Optional[Callable[[str, int, int], None]]
+
+_LOCK = threading.Lock()  # serializa leitura+gravação dentro do processo
+_IP = re.compile(r"^(\d{1,3}(\.\d{1,3}){3}|[0-9a-fA-F:]*:[0-9a-fA-F:.]*)$")
+_STEP = 1000              # de quantos em quantos itens reportar progresso/checar cancelamento
+
+
+class Cancelled(Exception):
+    """Operação cancelada antes do commit; o hosts não foi alterado."""
+
+
+class _Cancel:
+    def __init__(self, cancel, progress: Progress):
+        self.cancel, self.progress = cancel, progress
+
+    def tick(self, stage: str, done: int, total: int):
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled()
+        if self.progress: self.progress(stage, done, total)
+
+
+def normalize(websites: Iterable[str]) -> List[str]:
+    """Remove esquema, caminho, porta e duplicatas; hosts não diferenciam maiúsculas."""
+    out: List[str] = []
+    seen: Set[str] = set()
+    for w in websites or []:
+        w = (w or "").strip()
+        if not w:
+            continue
+        w = w.replace("http://", "").replace("https://", "").strip("/ ")
+        w = w.split()[0].split("/")[0].split(":")[0].lower().rstrip(".") if w else ""
+        if w and w not in seen:
+            seen.add(w); out.append(w)
+    return out
+
+
+class HostsFile:
+    """Conteúdo do hosts já interpretado. `lines` guarda o texto original (comentários e
+    entradas de outros IPs ficam intactos); `blocked` indexa host -> linhas que o redirecionam."""
+    def __init__(self, lines: List[str], redirect: str = IP_REDIRECT):
+        self.lines: List[Optional[str]] = lines
+        self.redirect = redirect
+        self.blocked: Dict[str, List[int]] = {}
+        self.changed = False
+        for i, line in enumerate(lines):
+            for host in self._hosts(line):
+                self.blocked.setdefault(host, []).append(i)
+
+    @classmethod
+    def load(cls, path: str, redirect: str = IP_REDIRECT) -> "HostsFile":
+        try:
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                return cls(f.read().splitlines(), redirect)
+        except FileNotFoundError:
+            return cls([], redirect)
+
+    def _hosts(self, line: str) -> List[str]:
+        parts = line.split("#", 1)[0].split()
+        if len(parts) < 2 or parts[0] != self.redirect:
+            return []
+        return [h.lower() for h in parts[1:]]
+
+    def block(self, sites: List[str], tick: _Cancel) -> int:
+        added = 0
+        for n, s in enumerate(sites, 1):
+            if n % _STEP == 0: tick.tick("bloqueando", n, len(sites))
+            if s in self.blocked:
+                continue
+            self.blocked[s] = [len(self.lines)]
+            self.lines.append(f"{self.redirect} {s}")
+            added += 1
+        self.changed |= bool(added)
+        return added
+
+    def unblock(self, sites: List[str], tick: _Cancel) -> int:
+        """Remove o domínio e seus subdomínios (desbloquear `site.com` libera `www.site.com`)."""
+        targets = set(sites)
+        doomed: Set[str] = set()
+        for n, host in enumerate(list(self.blocked), 1):
+            if n % _STEP == 0: tick.tick("desbloqueando", n, len(self.blocked))
+            labels = host.split(".")
+            if any(".".join(labels[i:]) in targets for i in range(len(labels))):
+                doomed.add(host)
+        touched: Set[int] = set()
+        for host in doomed:
+            touched.update(self.blocked.pop(host))
+        for i in touched:
+            line = self.lines[i]
+            body, _, comment = line.partition("#")
+            keep = [h for h in body.split()[1:] if h.lower() not in doomed]
+            # linha com vários hosts: mantém os que não foram liberados
+            self.lines[i] = (" ".join([self.redirect] + keep) + (" #" + comment if comment else "")) if keep else None
+        self.changed |= bool(doomed)
+        return len(doomed)
+
+    def hosts(self) -> List[str]:
+        return sorted(self.blocked, key=lambda h: min(self.blocked[h]))
+
+    def commit(self, path: str):
+        """Grava tudo de uma vez: arquivo temporário na mesma pasta + os.replace.
+        hosts somente leitura (proteção comum no Windows) é liberado para a gravação e
+        volta a ficar somente leitura no fim, tenha ou não dado certo."""
+        text = "".join(line + "\n" for line in self.lines if line is not None)
+        try: orig_mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError: orig_mode = None
+        writable = (orig_mode if orig_mode is not None else 0o644) | stat.S_IWRITE | stat.S_IREAD
+        d = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(prefix=".hosts-", dir=d)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text); f.flush(); os.fsync(f.fileno())
+            os.chmod(tmp, writable)
+            if orig_mode is not None and orig_mode != writable:
+                os.chmod(path, writable)  # no Windows, os.replace falha sobre alvo somente leitura
+            try:
+                os.replace(tmp, path)
+            except PermissionError:
+                # antivírus/serviço DNS segurando o hosts: cai para reescrita no lugar
+                with open(path, "w", encoding="utf-8") as f: f.write(text)
+                os.remove(tmp)
+        except BaseException:
+            try: os.remove(tmp)
+            except OSError: pass
+            raise
+        finally:
+            if orig_mode is not None and orig_mode != writable:
+                try: os.chmod(path, orig_mode)
+                except OSError: pass
+        self.changed = False
+
+
+def apply(path: str, block: Iterable[str] = (), unblock: Iterable[str] = (), redirect: str = IP_REDIRECT,
+          progress: Progress = None, cancel=None) -> Tuple[int, int]:
+    """Bloqueia/desbloqueia em uma passada e retorna (adicionados, removidos).
+    `cancel` é qualquer objeto com is_set() (threading.Event); cancelado antes do commit,
+    o hosts fica como estava e Cancelled é levantada."""
+    tick = _Cancel(cancel, progress)
+    to_block, to_unblock = normalize(block), normalize(unblock)
+    with _LOCK:
+        tick.tick("lendo", 0, 1)
+        hf = HostsFile.load(path, redirect)
+        added = hf.block(to_block, tick) if to_block else 0
+        removed = hf.unblock(to_unblock, tick) if to_unblock else 0
+        tick.tick("gravando", 0, 1)
+        if hf.changed:
+            hf.commit(path)
+        if progress: progress("concluido", 1, 1)
+    return added, removed
+
+
+def list_blocked(path: str, redirect: str = IP_REDIRECT) -> List[str]:
+    return HostsFile.load(path, redirect).hosts()
+
+
+def read_domain_list(path: str, progress: Progress = None, cancel=None) -> List[str]:
+    """Lê uma lista de domínios de um arquivo: um por linha, `#` comenta, e linhas no
+    formato hosts (`0.0.0.0 a.com b.com`) também valem."""
+    tick = _Cancel(cancel, progress)
+    total = max(1, os.path.getsize(path))
+    raw: List[str] = []
+    done = 0
+    with open(path, "r", encoding="utf-8-sig", errors="ignore") as f:
+        for n, line in enumerate(f, 1):
+            done += len(line)
+            if n % (_STEP * 10) == 0: tick.tick("importando", min(done, total), total)
+            parts = line.split("#", 1)[0].split()
+            if not parts:
+                continue
+            raw.extend(parts[1:] if _IP.match(parts[0]) else parts[:1])
+    return normalize(raw)
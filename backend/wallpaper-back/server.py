@@ -1,17 +1,28 @@
 # agent.py
-import os, io, sys, csv, time, json, shutil, ctypes, socket, hashlib, platform, datetime, logging, traceback, subprocess
-from logging.handlers import RotatingFileHandler
+import os, io, sys, csv, time, json, atexit, shutil, ctypes, socket, asyncio, concurrent.futures, hashlib, platform, datetime, logging, threading, traceback, subprocess
+import re, uuid, queue, math, random, warnings
+from array import array
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from typing import Optional, Dict, Any, Tuple, List
 
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, Response, status, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 from pydantic_settings import BaseSettings
 from bson import ObjectId
 from pymongo import MongoClient, ASCENDING
 from pymongo.errors import ConnectionFailure, DuplicateKeyError
 from gridfs import GridFS, NoFile
-from PIL import Image
+from PIL import Image, ImageOps
 from typing import List as _List
+import hosts_engine
+import gzip
+try: import brotli            # opcional: Content-Encoding br
+except ImportError: brotli = None
+try: import msgpack           # opcional: Accept: application/msgpack
+except ImportError: msgpack = None
 
 # ============== CONFIG / SETTINGS ==============
 
@@ -34,13 +45,107 @@ def _writable_dir() -> str:
         except: pass
     return os.getcwd()
 
+class _JsonFormatter(logging.Formatter):
+    """Uma linha JSON por registro; campos de contexto entram quando passados via `extra=`."""
+    FIELDS = ("route", "method", "file_id", "duration_ms", "outcome", "suppressed")
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname, "thread": record.threadName, "msg": record.getMessage(),
+        }
+        for k in self.FIELDS:
+            v = getattr(record, k, None)
+            if v is not None: out[k] = v
+        if record.exc_info: out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class _RateLimitFilter(logging.Filter):
+    """Avisos repetitivos (ping do Mongo, Registro...) marcados com `extra={"rate_key": ...}`
+    passam no máximo uma vez por janela; o próximo que passar informa quantos foram suprimidos."""
+    def __init__(self, window: float):
+        super().__init__()
+        self.window = window
+        self._lock = threading.Lock()
+        self._seen: Dict[str, Tuple[float, int]] = {}
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "rate_key", None)
+        if not key: return True
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._seen.get(key, (-self.window, 0))
+            if now - last < self.window:
+                self._seen[key] = (last, suppressed + 1)
+                return False
+            self._seen[key] = (now, 0)
+        if suppressed: record.suppressed = suppressed
+        return True
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Só enfileira: formatação, rotação e flush acontecem na thread do QueueListener.
+    Fila cheia (disco travado) descarta o registro em vez de bloquear a requisição."""
+    dropped = 0
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # mesmo processo: não precisa pré-formatar/serializar
+    def enqueue(self, record: logging.LogRecord):
+        try: self.queue.put_nowait(record)
+        except queue.Full: _NonBlockingQueueHandler.dropped += 1
+
 LOG_DIR = _writable_dir()
+LOG_RATE_WINDOW = 60.0
 logger = logging.getLogger("WallpaperAgent")
 logger.setLevel(logging.INFO)
 handler = RotatingFileHandler(os.path.join(LOG_DIR, "wallpaper_agent.log"), maxBytes=2*1024*1024, backupCount=5, encoding="utf-8")
-handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(handler)
-logger.addHandler(logging.StreamHandler())
+handler.setFormatter(_JsonFormatter())
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=10000)
+_queue_handler = _NonBlockingQueueHandler(_log_queue)
+_queue_handler.addFilter(_RateLimitFilter(LOG_RATE_WINDOW))
+logger.addHandler(_queue_handler)
+logger.propagate = False
+_log_listener = QueueListener(_log_queue, handler, console, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# ============== PLATAFORMA (APIs do Windows) ==============
+
+class WindowsPlatform:
+    """Único ponto de acesso a Registro, SystemParametersInfo, kernel32 e comandos
+    externos (wmic/getmac/shutdown). Fora do Windows as chamadas falham e o agente
+    segue com os fallbacks de sempre; o benchmark (bench/) troca `PLATFORM` por uma
+    implementação falsa para rodar no Linux.
+    """
+    def winreg(self):
+        import winreg
+        return winreg
+
+    def spi(self, action: int, param: int, value, flags: int) -> int:
+        return ctypes.windll.user32.SystemParametersInfoW(action, param, value, flags)
+
+    def last_error(self) -> int:
+        return ctypes.get_last_error()
+
+    def run(self, args: List[str], timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        return subprocess.run(args, capture_output=True, text=True, timeout=timeout)
+
+    def memory_status(self) -> Tuple[int, float]:
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_=[("dwLength", ctypes.c_ulong),("dwMemoryLoad", ctypes.c_ulong),
+                      ("ullTotalPhys", ctypes.c_ulonglong),("ullAvailPhys", ctypes.c_ulonglong),
+                      ("ullTotalPageFile", ctypes.c_ulonglong),("ullAvailPageFile", ctypes.c_ulonglong),
+                      ("ullTotalVirtual", ctypes.c_ulonglong),("ullAvailVirtual", ctypes.c_ulonglong),
+                      ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+        st = MEMORYSTATUSEX(); st.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(st))
+        return st.ullTotalPhys, float(st.dwMemoryLoad)
+
+    def system_times(self) -> Optional[Tuple[float, float]]:
+        idle, kernel, user = (ctypes.c_ulonglong(), ctypes.c_ulonglong(), ctypes.c_ulonglong())
+        if ctypes.windll.kernel32.GetSystemTimes(ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user)):
+            return float(idle.value), float(kernel.value + user.value)  # kernel já inclui o ocioso
+        return None
+
+PLATFORM = WindowsPlatform()
 
 REGISTRY_PATH = r"Software\WallpaperAgent"
 
@@ -64,13 +169,54 @@ class _Defaults(BaseSettings):
     # Limpeza
     DAYS_TO_KEEP: int = 30
 
+    # Upload retomável
+    UPLOAD_MAX_MB: int = 50           # tamanho máximo aceito por upload (multipart ou retomável)
+    UPLOAD_CHUNK_KB: int = 1024       # tamanho de pedaço sugerido ao cliente
+    UPLOAD_SESSION_TTL_H: int = 24    # sessão sem atividade expira e é removida do spool
+
+    # Admissão de imagens (checada pelo cabeçalho, antes de gravar)
+    IMG_MAX_PIXELS: int = 33_177_600  # 7680x4320; também vira o limite de decodificação do Pillow
+    IMG_FORMATS: str = "JPEG,PNG,BMP,WEBP"
+    IMG_DECODE_MAX_SIDE: int = 7680   # maior lado decodificado ao aplicar (JPEG reduz já no decoder)
+
+    # Agenda/rotação de papéis de parede (pré-busca local)
+    SCHEDULE_PREFETCH_H: float = 12   # baixa e converte itens que entram nas próximas N horas
+    SCHEDULE_JITTER_MIN: int = 120    # espalha a pré-busca da frota em até N minutos
+    SCHEDULE_LEAD_MIN: int = 10       # a pré-busca termina pelo menos N minutos antes da troca
+
+    # Quase-duplicatas (dHash de 64 bits, distância de Hamming)
+    PHASH_MAX_DISTANCE: int = 6       # até quantos bits diferentes contam como "mesma imagem"
+    PHASH_REFRESH_H: int = 6          # de quanto em quanto tempo o índice relê os hashes do bucket
+
+    # Canonicalização (re-encode) das imagens armazenadas
+    CANON_ENABLED: bool = False       # re-encoda uploads antes de gravar no GridFS
+    CANON_FORMAT: str = "JPEG"        # JPEG ou WEBP
+    CANON_QUALITY: int = 88
+    CANON_MAX_SIDE: int = 3840        # maior lado armazenado
+    CANON_KEEP_ORIGINAL: bool = False # guarda também o original (ou `manter_original` por upload)
+
+    # Relatório de armazenamento (/storage/report)
+    STORAGE_REPORT_TTL_S: int = 300   # reaproveita o último resultado por N segundos
+
+    # Compressão das respostas (gzip/br conforme Accept-Encoding)
+    COMPRESS_MIN_BYTES: int = 1024    # respostas menores saem sem compressão
+
+    # Stream de status (SSE)
+    STATUS_WATCH_INTERVAL: int = 15   # segundos entre verificações (disco/Mongo/Registro) enquanto houver ouvintes
+    STATUS_KEEPALIVE: int = 25        # comentário keepalive para proxies não derrubarem a conexão
+    STATUS_RETRY_S: int = 3           # espera do EventSource antes de reconectar (campo `retry:`)
+    DISK_LOW_GB: float = 10.0         # limiar de disco livre que gera evento "disk"
+
+    # Histórico de métricas (disco/memória/CPU)
+    METRICS_INTERVAL: int = 10        # segundos entre amostras brutas
+
     class Config:
         env_file = ".env"
         extra = "ignore"
 
 def _read_registry_values(names: List[str]) -> Dict[str, Any]:
     try:
-        import winreg
+        winreg = PLATFORM.winreg()
         k = winreg.OpenKey(winreg.HKEY_CURRENT_USER, REGISTRY_PATH, 0, winreg.KEY_READ)
         vals = {}
         for name in names:
@@ -87,12 +233,12 @@ def _read_registry_values(names: List[str]) -> Dict[str, Any]:
 
 def _write_registry_value(name: str, value: str):
     try:
-        import winreg
+        winreg = PLATFORM.winreg()
         k = winreg.CreateKey(winreg.HKEY_CURRENT_USER, REGISTRY_PATH)
         winreg.SetValueEx(k, name, 0, winreg.REG_SZ, str(value))
         k.Close()
     except Exception as e:
-        logger.warning(f"Falha ao gravar {name} no Registro: {e}")
+        logger.warning("Falha ao gravar %s no Registro: %s", name, e, extra={"rate_key": "registry_write"})
 
 def _persist_overrides(**kwargs):
     """Persiste chaves no Registro e tenta refletir em ProgramData/config.json.
@@ -103,7 +249,7 @@ def _persist_overrides(**kwargs):
         try:
             _write_registry_value(str(k), str(v))
         except Exception as e:
-            logger.warning(f"Persistência Registro {k}: {e}")
+            logger.warning("Persistência Registro %s: %s", k, e)
     # ProgramData/config.json
     try:
         cfg_dir = os.path.join(os.environ.get('PROGRAMDATA', ''), "WallpaperAgent")
@@ -119,7 +265,7 @@ def _persist_overrides(**kwargs):
         with open(cfg_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
     except Exception as e:
-        logger.warning(f"Persistência ProgramData: {e}")
+        logger.warning("Persistência ProgramData: %s", e)
 
 def _load_settings() -> _Defaults:
     # 1) defaults + .env
@@ -133,7 +279,7 @@ def _load_settings() -> _Defaults:
                 data = json.load(f)
             s = _Defaults(**{**s.model_dump(), **data})
         except Exception as e:
-            logger.warning(f"Falha ao ler {cfg_path}: {e}")
+            logger.warning("Falha ao ler %s: %s", cfg_path, e)
 
     # 3) Registro (sobrepõe)
     overrides = _read_registry_values([
@@ -154,7 +300,7 @@ def _load_settings() -> _Defaults:
             s = _Defaults(**{**s.model_dump(), "AGENT_KEY": gen})
             logger.info("AGENT_KEY gerado e salvo no Registro.")
         except Exception as e:
-            logger.warning(f"Não foi possível gerar AGENT_KEY: {e}")
+            logger.warning("Não foi possível gerar AGENT_KEY: %s", e)
 
     # Aviso sobre MONGO_URI ausente
     if not s.MONGO_URI:
@@ -167,7 +313,7 @@ S = _load_settings()
 
 def _machine_guid() -> str:
     try:
-        import winreg
+        winreg = PLATFORM.winreg()
         k = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Cryptography", 0,
                            winreg.KEY_READ | getattr(winreg, 'KEY_WOW64_64KEY', 0))
         v, _ = winreg.QueryValueEx(k, "MachineGuid"); k.Close(); return str(v)
@@ -180,7 +326,7 @@ def _code_from_guid(g: str) -> str:
 
 def get_or_create_machine_code() -> str:
     try:
-        import winreg
+        winreg = PLATFORM.winreg()
         try:
             k = winreg.OpenKey(winreg.HKEY_CURRENT_USER, REGISTRY_PATH, 0, winreg.KEY_READ)
             code, _ = winreg.QueryValueEx(k, "MachineCode"); k.Close()
@@ -206,8 +352,7 @@ def _bytes_to_gb(n: int) -> float:
 def motherboard_info() -> Dict[str, Any]:
     info = {"manufacturer": None, "product": None, "serial": None}
     try:
-        r = subprocess.run(["wmic","baseboard","get","Manufacturer,Product,SerialNumber","/format:csv"],
-                           capture_output=True, text=True, timeout=5)
+        r = PLATFORM.run(["wmic","baseboard","get","Manufacturer,Product,SerialNumber","/format:csv"], timeout=5)
         if r.returncode==0 and r.stdout:
             lines = [l for l in (x.strip() for x in r.stdout.splitlines()) if l]
             if len(lines)>=2:
@@ -221,8 +366,7 @@ def motherboard_info() -> Dict[str, Any]:
 def cpu_info() -> Dict[str, Any]:
     info = {"name": None, "cores": None, "threads": None}
     try:
-        r = subprocess.run(["wmic","cpu","get","Name,NumberOfCores,NumberOfLogicalProcessors","/format:csv"],
-                           capture_output=True, text=True, timeout=5)
+        r = PLATFORM.run(["wmic","cpu","get","Name,NumberOfCores,NumberOfLogicalProcessors","/format:csv"], timeout=5)
         if r.returncode==0 and r.stdout:
             lines = [l for l in (x.strip() for x in r.stdout.splitlines()) if l]
             if len(lines)>=2:
@@ -237,33 +381,41 @@ def cpu_info() -> Dict[str, Any]:
         except: pass
     return info
 
+def _disk_usage():
+    try: return shutil.disk_usage(os.getenv('SystemDrive') + "\\")
+    except: return shutil.disk_usage("/")
+
+def _memory_status() -> Tuple[int, float]:
+    """(RAM total em bytes, % de uso)."""
+    try:
+        import psutil
+        vm = psutil.virtual_memory(); return vm.total, float(vm.percent)
+    except:
+        return PLATFORM.memory_status()
+
+def _cpu_times() -> Optional[Tuple[float, float]]:
+    """(ocioso, total) acumulados desde o boot; a carga sai da diferença entre duas leituras."""
+    try:
+        import psutil
+        t = psutil.cpu_times(); return t.idle, sum(t)
+    except: pass
+    try: return PLATFORM.system_times()
+    except: return None
+
 def system_info(PORT:int) -> Dict[str,Any]:
     info: Dict[str,Any] = {}
     try:
         info["device_name"] = os.environ.get("COMPUTERNAME") or platform.node() or "Desconhecido"
         # RAM
-        try:
-            import psutil
-            info["ram_total_gb"] = _bytes_to_gb(psutil.virtual_memory().total)
-        except:
-            class MEMORYSTATUSEX(ctypes.Structure):
-                _fields_=[("dwLength", ctypes.c_ulong),("dwMemoryLoad", ctypes.c_ulong),
-                          ("ullTotalPhys", ctypes.c_ulonglong),("ullAvailPhys", ctypes.c_ulonglong),
-                          ("ullTotalPageFile", ctypes.c_ulonglong),("ullAvailPageFile", ctypes.c_ulonglong),
-                          ("ullTotalVirtual", ctypes.c_ulonglong),("ullAvailVirtual", ctypes.c_ulonglong),
-                          ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
-            st = MEMORYSTATUSEX(); st.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
-            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(st))
-            info["ram_total_gb"] = _bytes_to_gb(st.ullTotalPhys)
+        info["ram_total_gb"] = _bytes_to_gb(_memory_status()[0])
         # Disco
-        try: total, used, free = shutil.disk_usage(os.getenv('SystemDrive') + "\\")
-        except: total, used, free = shutil.disk_usage("/")
+        total, used, free = _disk_usage()
         info["storage_total_gb"]=_bytes_to_gb(total); info["storage_free_gb"]=_bytes_to_gb(free)
         # MB e CPU
         info["motherboard"]=motherboard_info(); info["cpu"]=cpu_info()
         ip = local_ip(); info["ip"]=ip; info["agent_url"]=f"http://{ip}:{PORT}"
     except Exception as e:
-        logger.warning(f"Falha ao coletar informações do sistema: {e}")
+        logger.warning("Falha ao coletar informações do sistema: %s", e, extra={"rate_key": "system_info"})
     return info
 
 # ============== DB / GRIDFS (com índice de dedupe) ==============
@@ -280,7 +432,7 @@ class DB:
             self.client.admin.command("ping")
             logger.info("MongoDB ping OK")
         except Exception as e:
-            logger.error(f"Falha ao conectar ao MongoDB: {e}")
+            logger.error("Falha ao conectar ao MongoDB: %s", e)
             raise
 
         db = self.client[S.DB_NAME]
@@ -297,15 +449,23 @@ class DB:
                 partialFilterExpression={"metadata.sha256": {"$type": "string"}},
             )
         except Exception as e:
-            logger.warning(f"Índice uniq_sha256: {e}")
+            logger.warning("Índice uniq_sha256: %s", e)
+        try:
+            files.create_index([("metadata.aliases", 1)], name="aliases", background=True)
+        except Exception as e:
+            logger.warning("Índice aliases: %s", e)
         try:
             files.create_index([("metadata.lastUsedAt", 1)], background=True)
         except Exception as e:
-            logger.warning(f"Índice lastUsedAt: {e}")
+            logger.warning("Índice lastUsedAt: %s", e)
         try:
             files.create_index([("uploadDate", 1)], background=True)
         except Exception as e:
-            logger.warning(f"Índice uploadDate: {e}")
+            logger.warning("Índice uploadDate: %s", e)
+        try:
+            files.create_index([("metadata.useCount", -1)], name="useCount", background=True)
+        except Exception as e:
+            logger.warning("Índice useCount: %s", e)
 
         self.fs = GridFS(db, collection=S.WALLPAPER_COLLECTION)
         logger.info("GridFS pronto")
@@ -316,17 +476,35 @@ DBI.init()
 def _compute_sha256(data: bytes) -> str:
     h = hashlib.sha256(); h.update(data); return h.hexdigest()
 
-def save_img_dedup(data: bytes, filename: str, content_type: str) -> str:
-    sha = _compute_sha256(data)
+def find_img_by_sha(sha: str) -> Optional[str]:
+    """Arquivo servível com esse sha256 — o próprio ou o de um original já canonicalizado
+    (`metadata.aliases`). Originais guardados a pedido (`role: original`) não contam."""
+    db = DBI.client[S.DB_NAME]
+    doc = db[f"{S.WALLPAPER_COLLECTION}.files"].find_one(
+        {"$or": [{"metadata.sha256": sha}, {"metadata.aliases": sha}], "metadata.role": {"$ne": "original"}}, {"_id": 1})
+    return str(doc["_id"]) if doc else None
+
+def save_img_dedup(data, filename: str, content_type: str, sha: Optional[str] = None, size: Optional[int] = None,
+                   extra_meta: Optional[Dict[str, Any]] = None) -> str:
+    """`data` pode ser bytes ou um arquivo binário aberto (upload retomável); nesse caso
+    `sha` e `size` vêm do chamador e o GridFS lê o arquivo em blocos, sem carregá-lo inteiro.
+    `extra_meta` entra em `metadata` (canonicalização: aliases, canonical, originalId, role).
+    Fora os originais guardados, grava também `metadata.phash` e entra no índice de similares."""
+    sha = sha or _compute_sha256(data)
+    size = len(data) if size is None else size
     db = DBI.client[S.DB_NAME]
     files = db[f"{S.WALLPAPER_COLLECTION}.files"]
 
     # Existe?
-    doc = files.find_one({"metadata.sha256": sha}, {"_id": 1})
-    if doc:
-        return str(doc["_id"])
+    existing = find_img_by_sha(sha)
+    if existing:
+        return existing
 
     # Não existe: salva
+    extra = dict(extra_meta or {})
+    if extra.get("role") != "original" and "phash" not in extra:
+        h = dhash(data)
+        if h is not None: extra["phash"] = _phash_hex(h)
     try:
         fid = DBI.fs.put(
             data,
@@ -334,12 +512,14 @@ def save_img_dedup(data: bytes, filename: str, content_type: str) -> str:
             content_type=content_type or "image/jpeg",
             metadata={
                 "sha256": sha,
-                "bytes": len(data),
+                "bytes": size,
                 "uploadedAt": datetime.datetime.now(datetime.timezone.utc),
                 "lastUsedAt": None,
+                **extra,
             },
             uploadDate=datetime.datetime.now(datetime.timezone.utc),
         )
+        if extra.get("phash"): PHASH_INDEX.add(int(extra["phash"], 16), str(fid))
         return str(fid)
     except DuplicateKeyError:
         # corrida rara: alguém inseriu no meio
@@ -357,10 +537,11 @@ def mark_wallpaper_used(file_id: str):
         files = db[f"{S.WALLPAPER_COLLECTION}.files"]
         files.update_one(
             {"_id": ObjectId(file_id)},
-            {"$set": {"metadata.lastUsedAt": datetime.datetime.now(datetime.timezone.utc)}}
+            {"$set": {"metadata.lastUsedAt": datetime.datetime.now(datetime.timezone.utc)},
+             "$inc": {"metadata.useCount": 1}}
         )
     except Exception as e:
-        logger.warning(f"Não foi possível marcar lastUsedAt para {file_id}: {e}")
+        logger.warning("Não foi possível marcar lastUsedAt para %s: %s", file_id, e, extra={"rate_key": "mongo_last_used"})
 
 def read_img(file_id: str) -> Dict[str,Any]:
     try:
@@ -373,6 +554,46 @@ def read_img(file_id: str) -> Dict[str,Any]:
         logger.exception("Erro ao recuperar imagem")
         raise HTTPException(status_code=500, detail=f"Erro ao recuperar a imagem: {e}")
 
+# ============== SINGLE-FLIGHT (coalescência de chamadas) ==============
+
+class SingleFlight:
+    """Chamadas concorrentes com a mesma chave compartilham uma única execução:
+    o primeiro chamador executa `fn`, os demais esperam e recebem o mesmo
+    resultado (ou a mesma exceção). Nada é guardado depois que a chamada termina.
+    Chaves em uso: "status:<base_url>", "file:<id>", "storage_report".
+    """
+    class _Call:
+        __slots__ = ("done", "result", "error")
+        def __init__(self):
+            self.done = threading.Event(); self.result = None; self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, "SingleFlight._Call"] = {}
+
+    def do(self, key: str, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None: raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+FLIGHT = SingleFlight()
+
 # ============== SEGURANÇA OPCIONAL (X-AGENT-KEY) ==============
 
 def require_key(x_agent_key: Optional[str] = None):
@@ -382,27 +603,499 @@ def require_key(x_agent_key: Optional[str] = None):
 
 # ============== INTEGRAÇÃO USUÁRIO/MÁQUINA ==============
 
+# ============== ADMISSÃO DE IMAGENS ==============
+
+SNIFF_BYTES = 64 * 1024        # cabeçalho lido para descobrir formato/dimensões
+SNIFF_MAX_BYTES = 1024 * 1024  # JPEG com EXIF/miniatura grande pode empurrar o SOF mais para frente
+
+Image.MAX_IMAGE_PIXELS = S.IMG_MAX_PIXELS
+
+class AdmissionStats:
+    """Contadores de aceite/rejeição expostos em /metrics/admission."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.rejected: Dict[str, int] = {}
+        self.rejected_bytes = 0
+
+    def accept(self):
+        with self._lock: self.accepted += 1
+
+    def reject(self, reason: str, nbytes: Optional[int], status_code: int, detail: str) -> HTTPException:
+        with self._lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+            self.rejected_bytes += nbytes or 0
+        logger.warning("Imagem rejeitada (%s): %s", reason, detail, extra={"outcome": f"rejected:{reason}", "rate_key": f"admission:{reason}"})
+        return HTTPException(status_code=status_code, detail=detail)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"accepted": self.accepted, "rejected": dict(self.rejected), "rejected_bytes": self.rejected_bytes}
+
+ADMISSION = AdmissionStats()
+
+def _allowed_formats() -> List[str]:
+    return [f.strip().upper() for f in S.IMG_FORMATS.split(",") if f.strip()]
+
+def admit_image(head: bytes, total_size: Optional[int], final: bool = True) -> Optional[Dict[str, Any]]:
+    """Decide pelo cabeçalho (`head`), sem decodificar pixels, se a imagem pode ser gravada.
+    Levanta HTTPException 413/415 contando a rejeição; com `final=False` e cabeçalho ainda
+    inconclusivo retorna None para o chamador tentar de novo com mais bytes.
+    """
+    max_bytes = S.UPLOAD_MAX_MB * 1024 * 1024
+    if total_size is not None and total_size > max_bytes:
+        raise ADMISSION.reject("bytes", total_size, 413, f"Arquivo maior que {S.UPLOAD_MAX_MB} MB")
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            with Image.open(io.BytesIO(head)) as im:  # só lê o cabeçalho
+                fmt, (w, h) = im.format, im.size
+    except Image.DecompressionBombError:
+        raise ADMISSION.reject("pixels", total_size, 413, f"Imagem excede {S.IMG_MAX_PIXELS} pixels")
+    except Exception:
+        if not final: return None
+        raise ADMISSION.reject("format", total_size, 415, "Formato de imagem não reconhecido")
+    if (fmt or "").upper() not in _allowed_formats():
+        raise ADMISSION.reject("format", total_size, 415, f"Formato {fmt} não permitido. Use: {', '.join(_allowed_formats())}")
+    if w * h > S.IMG_MAX_PIXELS:
+        raise ADMISSION.reject("pixels", total_size, 413, f"Imagem {w}x{h} excede {S.IMG_MAX_PIXELS} pixels")
+    ADMISSION.accept()
+    return {"format": fmt, "width": w, "height": h}
+
+def _bounded_decode(im: Image.Image) -> Image.Image:
+    """Decodifica para RGB com memória limitada: recusa acima de IMG_MAX_PIXELS e reduz
+    para no máximo IMG_DECODE_MAX_SIDE (JPEG já decodifica em escala menor via draft)."""
+    if im.width * im.height > S.IMG_MAX_PIXELS:
+        raise ValueError(f"Imagem {im.width}x{im.height} excede {S.IMG_MAX_PIXELS} pixels")
+    side = S.IMG_DECODE_MAX_SIDE
+    if max(im.size) > side:
+        r = side / max(im.size)
+        box = (max(1, int(im.width * r)), max(1, int(im.height * r)))
+        if im.format == "JPEG": im.draft("RGB", box)
+        im = im.convert('RGB')
+        im.thumbnail(box)
+        return im
+    return im.convert('RGB')
+
+# ============== SIMILARIDADE (dHash + índice de Hamming) ==============
+
+def dhash(src) -> Optional[int]:
+    """dHash de 64 bits: gradiente horizontal de uma miniatura 9x8 em tons de cinza.
+    Sobrevive a redimensionamento, re-compressão e pequenos cortes. `src` pode ser bytes
+    ou arquivo aberto (a posição é restaurada). None se a imagem não abrir."""
+    pos = None if isinstance(src, (bytes, bytearray)) else src.tell()
+    try:
+        with Image.open(io.BytesIO(src) if pos is None else src) as im:
+            if im.format == "JPEG": im.draft("L", (72, 64))  # decodifica já reduzido
+            px = im.convert("L").resize((9, 8), Image.LANCZOS).tobytes()
+    except Exception:
+        return None
+    finally:
+        if pos is not None: src.seek(pos)
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return h
+
+def _phash_hex(h: int) -> str:
+    return f"{h:016x}"
+
+class HammingIndex:
+    """Multi-index hashing: o hash de 64 bits é dividido em 4 blocos de 16 bits, cada um com
+    sua tabela. Se dois hashes diferem em até r bits, algum bloco difere em até r // 4
+    (casa dos pombos), então basta sondar as variações desse raio em cada tabela e conferir
+    os candidatos. Ao contrário da BK-tree, remove em O(1) e não degrada com hashes aleatórios."""
+    BLOCKS, BITS = 4, 16
+
+    def __init__(self):
+        self._hash: Dict[str, int] = {}
+        self._tables: List[Dict[int, set]] = [{} for _ in range(self.BLOCKS)]
+
+    def __len__(self):
+        return len(self._hash)
+
+    def _keys(self, h: int):
+        mask = (1 << self.BITS) - 1
+        return [(h >> (i * self.BITS)) & mask for i in range(self.BLOCKS)]
+
+    def add(self, h: int, item: str):
+        if self._hash.get(item) == h: return
+        self.remove(item)
+        self._hash[item] = h
+        for t, k in zip(self._tables, self._keys(h)): t.setdefault(k, set()).add(item)
+
+    def remove(self, item: str):
+        h = self._hash.pop(item, None)
+        if h is None: return
+        for t, k in zip(self._tables, self._keys(h)):
+            bucket = t.get(k)
+            if bucket is not None:
+                bucket.discard(item)
+                if not bucket: del t[k]
+
+    def search(self, h: int, radius: int) -> List[Tuple[int, str]]:
+        sub = radius // self.BLOCKS
+        probes = [0]
+        for _ in range(sub):  # todas as máscaras com até `sub` bits ligados
+            probes = list({p | (1 << b) for p in probes for b in range(self.BITS)} | set(probes))
+        seen: set = set()
+        out: List[Tuple[int, str]] = []
+        for t, k in zip(self._tables, self._keys(h)):
+            for p in probes:
+                for item in t.get(k ^ p, ()):
+                    if item in seen: continue
+                    seen.add(item)
+                    d = bin(self._hash[item] ^ h).count("1")
+                    if d <= radius: out.append((d, item))
+        return out
+
+class PhashIndex:
+    """Índice em memória de `metadata.phash` para achar quase-duplicatas sem varrer o Mongo.
+    Na subida só carrega os hashes já gravados (nenhum arquivo é baixado); o hash dos
+    arquivos antigos é calculado uma vez pelo PhashBackfillJob (POST /storage/phash)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = HammingIndex()
+        self.ready = threading.Event()
+
+    def add(self, h: int, fid: str):
+        with self._lock: self._index.add(h, fid)
+
+    def discard(self, fid: str):
+        with self._lock: self._index.remove(fid)
+
+    def candidates(self, h: int, radius: int) -> List[Tuple[str, int]]:
+        """(file_id, distância) dentro do raio, do mais parecido para o menos."""
+        with self._lock: hits = self._index.search(h, radius)
+        return [(fid, d) for d, fid in sorted(hits)]
+
+    def load(self) -> set:
+        files = DBI.client[S.DB_NAME][f"{S.WALLPAPER_COLLECTION}.files"]
+        seen = set()
+        for doc in files.find({"metadata.role": {"$ne": "original"}, "metadata.phash": {"$ne": None}},
+                              {"_id": 1, "metadata.phash": 1}):
+            fid = str(doc["_id"])
+            self.add(int(doc["metadata"]["phash"], 16), fid); seen.add(fid)
+        return seen
+
+    def build(self):
+        try: n = len(self.load())
+        except Exception as e:
+            logger.warning("Índice de similares: %s", e)
+            return
+        self.ready.set()
+        logger.info("Índice de similares: %s imagens", n)
+
+    def refresh(self) -> Tuple[int, int]:
+        """Sincroniza com o bucket, que é da frota inteira: entram os hashes gravados por outros
+        agentes e saem os arquivos que a limpeza de outro agente apagou. Retorna (novos, removidos)."""
+        with self._lock: before = set(self._index._hash)
+        seen = self.load()
+        gone = before - seen  # o que foi adicionado durante a leitura não está em `before`
+        for fid in gone: self.discard(fid)
+        return len(seen - before), len(gone)
+
+PHASH_INDEX = PhashIndex()
+
+_PHASH_CLAIM_TTL = datetime.timedelta(minutes=10)  # reserva de um agente que caiu volta a valer
+
+class PhashBackfillJob:
+    """Calcula `metadata.phash` dos arquivos gravados antes do índice de similares (job único,
+    como a canonicalização). Cada arquivo é reservado com find_one_and_update
+    (`metadata.phashClaim`), então agentes rodando o job ao mesmo tempo não baixam o mesmo blob.
+    Imagem que não abre fica com phash null e não é tentada de novo.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.status: Dict[str, Any] = {"running": False}
+
+    def start(self, limit: Optional[int]) -> bool:
+        with self._lock:
+            if self._thread and self._thread.is_alive(): return False
+            self.status = {"running": True, "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                           "processed": 0, "hashed": 0, "failed": 0}
+            self._thread = threading.Thread(target=self._run, args=(limit,), name="phash-backfill", daemon=True)
+            self._thread.start()
+            return True
+
+    def _claim(self, files) -> Optional[Dict[str, Any]]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return files.find_one_and_update(
+            {"metadata.phash": {"$exists": False}, "metadata.role": {"$ne": "original"},
+             "$or": [{"metadata.phashClaim": {"$exists": False}}, {"metadata.phashClaim": {"$lt": now - _PHASH_CLAIM_TTL}}]},
+            {"$set": {"metadata.phashClaim": now}}, projection={"_id": 1})
+
+    def _run(self, limit: Optional[int]):
+        st = self.status
+        try:
+            files = DBI.client[S.DB_NAME][f"{S.WALLPAPER_COLLECTION}.files"]
+            while limit is None or st["processed"] < limit:
+                doc = self._claim(files)
+                if doc is None: break
+                try: h = dhash(DBI.fs.get(doc["_id"]).read())
+                except NoFile: continue  # removido por outro agente depois da reserva
+                files.update_one({"_id": doc["_id"]}, {"$set": {"metadata.phash": None if h is None else _phash_hex(h)},
+                                                       "$unset": {"metadata.phashClaim": ""}})
+                if h is None: st["failed"] += 1
+                else:
+                    PHASH_INDEX.add(h, str(doc["_id"])); st["hashed"] += 1
+                st["processed"] += 1
+        except Exception as e:
+            st["error"] = str(e)
+            logger.warning("Cálculo de phash: %s", e, extra={"rate_key": "phash_backfill"})
+        finally:
+            st["running"] = False
+            st["finished_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            logger.info("Cálculo de phash concluído: %s arquivos (%s sem hash)", st["processed"], st["failed"])
+
+PHASH_JOB = PhashBackfillJob()
+
+def find_similar(data) -> Optional[Tuple[str, int]]:
+    """(file_id, distância) da imagem armazenada mais parecida, dentro de PHASH_MAX_DISTANCE.
+    O índice é deste agente e pode estar atrasado em relação ao bucket (a limpeza de outro
+    agente apaga arquivos), então cada candidato é conferido no Mongo antes de ser reaproveitado."""
+    h = dhash(data)
+    if h is None: return None
+    files = DBI.client[S.DB_NAME][f"{S.WALLPAPER_COLLECTION}.files"]
+    for fid, d in PHASH_INDEX.candidates(h, S.PHASH_MAX_DISTANCE):
+        try: oid = ObjectId(fid)
+        except Exception: oid = None
+        if oid and files.find_one({"_id": oid, "metadata.role": {"$ne": "original"}}, {"_id": 1}):
+            return fid, d
+        PHASH_INDEX.discard(fid)
+    return None
+
+# ============== CANONICALIZAÇÃO (re-encode) ==============
+
+_CANON_MIME = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+def canonicalize(data: bytes) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+    """Re-encoda para CANON_FORMAT/CANON_QUALITY com no máximo CANON_MAX_SIDE.
+    Retorna None quando o original já está no formato canônico e dentro do limite
+    (re-encodar JPEG sobre JPEG só perderia qualidade). Mesmos pixels -> mesmos bytes,
+    então BMP/PNG da mesma imagem caem no mesmo sha256 canônico.
+    """
+    fmt = S.CANON_FORMAT.upper()
+    with Image.open(io.BytesIO(data)) as im:
+        if (im.format or "").upper() == fmt and max(im.size) <= S.CANON_MAX_SIDE:
+            return None
+        box = (S.CANON_MAX_SIDE, S.CANON_MAX_SIDE)
+        if im.format == "JPEG": im.draft("RGB", box)
+        im = ImageOps.exif_transpose(im).convert("RGB")
+        im.thumbnail(box)
+        out = io.BytesIO()
+        if fmt == "WEBP": im.save(out, format="WEBP", quality=S.CANON_QUALITY, method=6)
+        else: im.save(out, format="JPEG", quality=S.CANON_QUALITY, optimize=True, progressive=True)
+        return out.getvalue(), {"format": fmt, "quality": S.CANON_QUALITY, "width": im.width, "height": im.height}
+
+def _canon_filename(filename: str) -> str:
+    base = os.path.splitext(filename or "wallpaper")[0]
+    return base + (".webp" if S.CANON_FORMAT.upper() == "WEBP" else ".jpg")
+
+def store_wallpaper(data: bytes, filename: str, content_type: str, sha: Optional[str] = None,
+                    keep_original: Optional[bool] = None) -> str:
+    """Grava a imagem com dedupe. Com CANON_ENABLED grava a versão canônica e registra o sha256
+    do original em `metadata.aliases`, para que o mesmo upload seja reconhecido sem re-encodar.
+    O original só é guardado com `keep_original` (ou CANON_KEEP_ORIGINAL)."""
+    sha = sha or _compute_sha256(data)
+    existing = find_img_by_sha(sha)
+    if existing or not S.CANON_ENABLED:
+        return existing or save_img_dedup(data, filename=filename, content_type=content_type, sha=sha)
+    canon = canonicalize(data)
+    if canon is None:
+        return save_img_dedup(data, filename=filename, content_type=content_type, sha=sha)
+    cdata, cinfo = canon
+    csha = _compute_sha256(cdata)
+    fid = find_img_by_sha(csha)
+    if fid:  # mesma imagem já existia em outra codificação: só registra o alias
+        db = DBI.client[S.DB_NAME]
+        db[f"{S.WALLPAPER_COLLECTION}.files"].update_one({"_id": ObjectId(fid)}, {"$addToSet": {"metadata.aliases": sha}})
+        return fid
+    extra: Dict[str, Any] = {"aliases": [sha], "canonical": {**cinfo, "originalBytes": len(data)}}
+    if keep_original if keep_original is not None else S.CANON_KEEP_ORIGINAL:
+        extra["originalId"] = ObjectId(save_img_dedup(data, filename=filename, content_type=content_type, sha=sha,
+                                                      extra_meta={"role": "original"}))
+    return save_img_dedup(cdata, filename=_canon_filename(filename), content_type=_CANON_MIME[cinfo["format"]],
+                          sha=csha, extra_meta=extra)
+
+class CanonicalizeJob:
+    """Re-encoda em lotes o acervo já gravado (um job por vez, em thread própria).
+    Cada arquivo é substituído mantendo o mesmo _id (URLs e WallpaperMongoID continuam válidos).
+    Antes de apagar o _id, uma cópia de segurança (role original, `canonBackupOf`) é gravada e
+    só sai depois da versão nova; se o agente cair no meio, recover() restaura na próxima
+    execução. Arquivos que viram cópia de outro (mesmo sha256 canônico) são só contados em `duplicates`.
+    """
+    _BACKUP_KEYS = ("role", "canonBackupOf", "canonBackupSha256")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recover_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.status: Dict[str, Any] = {"running": False}
+
+    def start(self, batch: int, limit: Optional[int], keep_original: bool) -> bool:
+        with self._lock:
+            if self._thread and self._thread.is_alive(): return False
+            self.status = {"running": True, "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                           "processed": 0, "reencoded": 0, "kept": 0, "duplicates": 0, "errors": 0,
+                           "bytes_before": 0, "bytes_after": 0, "bytes_reclaimed": 0}
+            self._thread = threading.Thread(target=self._run, args=(batch, limit, keep_original), name="canonicalize", daemon=True)
+            self._thread.start()
+            return True
+
+    def recover(self) -> int:
+        """Resolve cópias de segurança deixadas por uma execução interrompida: alvo ausente é
+        restaurado da cópia; presente, a cópia é apagada (ou vira o original guardado, se o
+        alvo aponta para ela). Roda na inicialização e no começo de cada job."""
+        files = DBI.client[S.DB_NAME][f"{S.WALLPAPER_COLLECTION}.files"]
+        done = 0
+        with self._recover_lock:
+            for b in list(files.find({"metadata.canonBackupOf": {"$exists": True}})):
+                m = b.get("metadata") or {}
+                target = m["canonBackupOf"]
+                try:
+                    cur = files.find_one({"_id": target}, {"metadata.originalId": 1})
+                    if cur is None:
+                        meta = {k: v for k, v in m.items() if k not in self._BACKUP_KEYS}
+                        meta["sha256"] = m.get("canonBackupSha256")
+                        self._put_at(files, target, DBI.fs.get(b["_id"]).read(), b.get("filename"),
+                                      b.get("contentType"), meta, b.get("uploadDate"))
+                        logger.warning("Canonicalização: %s restaurado da cópia de segurança", target)
+                    elif (cur.get("metadata") or {}).get("originalId") == b["_id"]:
+                        files.update_one({"_id": b["_id"]}, {"$unset": {"metadata.canonBackupOf": "", "metadata.canonBackupSha256": ""}})
+                        done += 1
+                        continue
+                    DBI.fs.delete(b["_id"])
+                    done += 1
+                except Exception as e:
+                    logger.warning("Canonicalização: cópia %s de %s não resolvida: %s", b["_id"], target, e,
+                                   extra={"rate_key": "canonicalize"})
+        return done
+
+    def _backup(self, files, g, data: bytes, meta: Dict[str, Any]) -> ObjectId:
+        """Cópia do arquivo atual gravada antes de apagá-lo (fora do dedupe/limpeza por ser role original)."""
+        bid = DBI.fs.put(data, filename=g.filename, content_type=g.content_type,
+                         metadata={**meta, "sha256": None, "role": "original",
+                                   "canonBackupOf": g._id, "canonBackupSha256": meta.get("sha256")})
+        files.update_one({"_id": bid}, {"$set": {"uploadDate": g.upload_date}})
+        return bid
+
+    def _put_at(self, files, oid: ObjectId, data: bytes, filename: Optional[str], content_type: Optional[str],
+                meta: Dict[str, Any], upload_date):
+        """Grava `data` no _id dado preservando uploadDate (o fs.put sempre grava a hora atual)."""
+        DBI.client[S.DB_NAME][f"{S.WALLPAPER_COLLECTION}.chunks"].delete_many({"files_id": oid})  # put interrompido
+        DBI.fs.put(data, _id=oid, filename=filename, content_type=content_type, metadata=meta)
+        if upload_date: files.update_one({"_id": oid}, {"$set": {"uploadDate": upload_date}})
+
+    def _run(self, batch: int, limit: Optional[int], keep_original: bool):
+        st = self.status
+        try:
+            st["recovered"] = self.recover()
+            files = DBI.client[S.DB_NAME][f"{S.WALLPAPER_COLLECTION}.files"]
+            query: Dict[str, Any] = {"metadata.canonical": {"$exists": False}, "metadata.role": {"$ne": "original"}}
+            last_id = None
+            while limit is None or st["processed"] < limit:
+                if last_id: query["_id"] = {"$gt": last_id}
+                n = batch if limit is None else min(batch, limit - st["processed"])
+                docs = list(files.find(query, {"_id": 1}).sort("_id", ASCENDING).limit(n))
+                if not docs: break
+                for d in docs:
+                    last_id = d["_id"]
+                    try: self._one(files, d["_id"], keep_original)
+                    except Exception as e:
+                        st["errors"] += 1
+                        logger.warning("Canonicalização %s: %s", d["_id"], e, extra={"rate_key": "canonicalize"})
+                    st["processed"] += 1
+                time.sleep(0.2)  # alivia o Mongo entre lotes
+        finally:
+            st["running"] = False
+            STORAGE_REPORT.invalidate()
+            st["finished_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            logger.info("Canonicalização concluída: %s arquivos, %s bytes recuperados", st["processed"], st["bytes_reclaimed"])
+
+    def _one(self, files, oid: ObjectId, keep_original: bool):
+        st = self.status
+        g = DBI.fs.get(oid)
+        data, meta = g.read(), dict(g.metadata or {})
+        canon = canonicalize(data)
+        if canon is None or len(canon[0]) >= len(data):
+            files.update_one({"_id": oid}, {"$set": {"metadata.canonical": {"kept": True}}})
+            st["kept"] += 1
+            return
+        cdata, cinfo = canon
+        csha = _compute_sha256(cdata)
+        other = find_img_by_sha(csha)
+        if other and other != str(oid):
+            files.update_one({"_id": oid}, {"$set": {"metadata.canonical": {"duplicateOf": ObjectId(other)}}})
+            st["duplicates"] += 1
+            return
+        new_meta = {**meta, "sha256": csha, "bytes": len(cdata),
+                    "aliases": sorted(set(meta.get("aliases") or []) | ({meta["sha256"]} if meta.get("sha256") else set())),
+                    "canonical": {**cinfo, "originalBytes": len(data)}}
+        bak = self._backup(files, g, data, meta)  # o _id nunca fica sem cópia no Mongo
+        if keep_original: new_meta["originalId"] = bak
+        DBI.fs.delete(oid)
+        try:
+            self._put_at(files, oid, cdata, _canon_filename(g.filename), _CANON_MIME[cinfo["format"]], new_meta, g.upload_date)
+        except Exception:
+            self._put_at(files, oid, data, g.filename, g.content_type, meta, g.upload_date)
+            DBI.fs.delete(bak)
+            raise
+        if keep_original:
+            files.update_one({"_id": bak}, {"$unset": {"metadata.canonBackupOf": "", "metadata.canonBackupSha256": ""}})
+        else:
+            DBI.fs.delete(bak)
+        st["reencoded"] += 1
+        st["bytes_before"] += len(data); st["bytes_after"] += len(cdata)
+        st["bytes_reclaimed"] += len(data) - len(cdata) - (len(data) if keep_original else 0)
+
+CANON_JOB = CanonicalizeJob()
+
 # ============== WINDOWS WALLPAPER ==============
 
+ESTILOS = ["preencher","ajustar","estender","ladrilhar","centralizar","esticar"]
+
 class WinWP:
     last_bmp_path: Optional[str] = None
     last_file_id: Optional[str] = None
 
     @staticmethod
-    def set_wallpaper(img_bytes: bytes, estilo: str = "preencher") -> bool:
-        import winreg
-        if not img_bytes: raise ValueError("Imagem vazia")
-        estilos = {"preencher":10,"ajustar":6,"estender":10,"ladrilhar":0,"centralizar":0,"esticar":2}
+    def _paths() -> Tuple[str, str, str]:
         appdata = os.getenv('APPDATA') or os.path.expanduser('~')
         base = os.path.join(appdata, 'WallpaperAgent'); os.makedirs(base, exist_ok=True)
-        bmp = os.path.join(base, 'wallpaper.bmp'); jpg = os.path.join(base, 'wallpaper.jpg')
+        return appdata, os.path.join(base, 'wallpaper.bmp'), os.path.join(base, 'wallpaper.jpg')
 
-        # Converter (Pillow)
+    @staticmethod
+    def convert(img_bytes: bytes, bmp: str, jpg: str):
+        """Converte para os dois formatos que o Windows usa (BMP do SPI e JPEG do TranscodedWallpaper)."""
         with Image.open(io.BytesIO(img_bytes)) as im:
-            im = im.convert('RGB')
+            im = _bounded_decode(im)
             im.save(bmp, format='BMP')
             im.save(jpg, format='JPEG', quality=92)
 
+    @staticmethod
+    def set_wallpaper(img_bytes: bytes, estilo: str = "preencher", file_id: Optional[str] = None) -> bool:
+        if not img_bytes: raise ValueError("Imagem vazia")
+        _, bmp, jpg = WinWP._paths()
+        WinWP.convert(img_bytes, bmp, jpg)
+        return WinWP._activate(estilo, file_id)
+
+    @staticmethod
+    def set_prepared(bmp_src: str, jpg_src: str, estilo: str = "preencher", file_id: Optional[str] = None) -> bool:
+        """Aplica um par BMP/JPEG já convertido (agenda): só cópia local, Registro e SPI."""
+        _, bmp, jpg = WinWP._paths()
+        shutil.copyfile(bmp_src, bmp)
+        shutil.copyfile(jpg_src, jpg)
+        return WinWP._activate(estilo, file_id)
+
+    @staticmethod
+    def _activate(estilo: str, file_id: Optional[str]) -> bool:
+        winreg = PLATFORM.winreg()
+        if file_id: WinWP.last_file_id = file_id
+        appdata, bmp, jpg = WinWP._paths()
+
         # Themes/TranscodedWallpaper
         themes = os.path.join(appdata, 'Microsoft','Windows','Themes')
         try:
@@ -411,12 +1104,12 @@ class WinWP:
             try: os.remove(os.path.join(themes,'Slideshow.ini'))
             except: pass
         except Exception as e:
-            logger.warning(f"TranscodedWallpaper: {e}")
+            logger.warning("TranscodedWallpaper: %s", e)
 
         SPI_SETDESKWALLPAPER=0x0014; SPI_SETDESKWALLPAPER_TILE=0x0016; SPIF_UPDATEINIFILE=0x01; SPIF_SENDCHANGE=0x02
 
         # ladrilhar on/off
-        ctypes.windll.user32.SystemParametersInfoW(SPI_SETDESKWALLPAPER_TILE, 1 if estilo=="ladrilhar" else 0, None, SPIF_UPDATEINIFILE|SPIF_SENDCHANGE)
+        PLATFORM.spi(SPI_SETDESKWALLPAPER_TILE, 1 if estilo=="ladrilhar" else 0, None, SPIF_UPDATEINIFILE|SPIF_SENDCHANGE)
 
         # Control Panel\Desktop
         k = winreg.CreateKey(winreg.HKEY_CURRENT_USER,"Control Panel\\Desktop")
@@ -437,6 +1130,7 @@ class WinWP:
         if WinWP.last_file_id:
             try:
                 winreg.SetValueEx(k,"WallpaperMongoID",0,winreg.REG_SZ,WinWP.last_file_id)
+                winreg.SetValueEx(k,"WallpaperEstilo",0,winreg.REG_SZ,estilo)
                 winreg.SetValueEx(k,"WallpaperLastChanged",0,winreg.REG_SZ,datetime.datetime.now().isoformat())
             except: pass
         k.Close()
@@ -446,30 +1140,147 @@ class WinWP:
             kb = winreg.CreateKey(winreg.HKEY_CURRENT_USER,"Software\\Microsoft\\Windows\\CurrentVersion\\Explorer\\Wallpapers")
             try: kb_val = 1; ctypes.c_int(kb_val)  # dummy só pra não dar lint
             except: pass
-            try: 
-                import winreg as wr
-                winreg.SetValueEx(kb,"BackgroundType",0,wr.REG_DWORD,1)
+            try: winreg.SetValueEx(kb,"BackgroundType",0,winreg.REG_DWORD,1)
             except: pass
             try: winreg.SetValueEx(kb,"ConvertedWallpaper",0,winreg.REG_SZ,bmp)
             except: pass
             kb.Close()
         except Exception as e:
-            logger.warning(f"Explorer\\Wallpapers: {e}")
+            logger.warning("Explorer\\Wallpapers: %s", e)
 
         if not os.path.exists(bmp):
             raise RuntimeError(f"BMP não encontrado: {bmp}")
 
-        ctypes.windll.user32.SystemParametersInfoW(SPI_SETDESKWALLPAPER,0,None,SPIF_UPDATEINIFILE|SPIF_SENDCHANGE)
-        ok = ctypes.windll.user32.SystemParametersInfoW(SPI_SETDESKWALLPAPER,0,bmp,SPIF_UPDATEINIFILE|SPIF_SENDCHANGE)
+        PLATFORM.spi(SPI_SETDESKWALLPAPER,0,None,SPIF_UPDATEINIFILE|SPIF_SENDCHANGE)
+        ok = PLATFORM.spi(SPI_SETDESKWALLPAPER,0,bmp,SPIF_UPDATEINIFILE|SPIF_SENDCHANGE)
         if not ok:
-            raise RuntimeError(f"SPI falhou (erro {ctypes.get_last_error()})")
+            raise RuntimeError(f"SPI falhou (erro {PLATFORM.last_error()})")
 
         WinWP.last_bmp_path = bmp
         return True
 
+def _default_bmp_path() -> str:
+    appdata = os.getenv('APPDATA') or os.path.expanduser('~')
+    return os.path.join(appdata,'WallpaperAgent','wallpaper.bmp')
+
+def _current_wallpaper_state() -> Tuple[str, str]:
+    """(WallpaperMongoID, WallpaperEstilo) gravados no Registro pela última aplicação."""
+    try:
+        winreg = PLATFORM.winreg()
+        k = winreg.OpenKey(winreg.HKEY_CURRENT_USER,"Control Panel\\Desktop",0,winreg.KEY_READ)
+        try: mid = winreg.QueryValueEx(k,"WallpaperMongoID")[0]
+        except: mid = ""
+        try: estilo = winreg.QueryValueEx(k,"WallpaperEstilo")[0]
+        except: estilo = ""
+        k.Close(); return mid, estilo
+    except: return "", ""
+
+# ============== FILA DE APLICAÇÃO (serializada, último vence) ==============
+
+class ApplyQueue:
+    """Serializa as aplicações de papel de parede em um único worker.
+    Só existe um pedido pendente por vez: um pedido novo substitui o anterior que
+    ainda não começou (o chamador substituído recebe status "substituido"), e o
+    worker volta a checar isso antes das etapas caras (conversão, Registro, SPI).
+    Como só o worker mexe em WinWP.last_* e em wallpaper.bmp, não há corrida.
+    Jobs com `prepared` vêm da agenda e vão para _apply_scheduled.
+    """
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._pending: Optional[Tuple[Dict[str, Any], concurrent.futures.Future]] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, **job) -> concurrent.futures.Future:
+        fut: concurrent.futures.Future = concurrent.futures.Future()
+        with self._cv:
+            if self._pending:
+                old_job, old_fut = self._pending
+                # o chamador pode ter desistido (tarefa cancelada cancela o Future junto)
+                if old_fut.set_running_or_notify_cancel():
+                    old_fut.set_result(_superseded_result(old_job))
+            self._pending = (job, fut)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name="apply-queue", daemon=True)
+                self._thread.start()
+            self._cv.notify()
+        return fut
+
+    def superseded(self) -> bool:
+        with self._cv:
+            return self._pending is not None
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._pending: self._cv.wait()
+                job, fut = self._pending; self._pending = None
+            if not fut.set_running_or_notify_cancel(): continue
+            try: fut.set_result(_apply_scheduled(**job) if "prepared" in job else _apply_wallpaper(**job))
+            except BaseException as e: fut.set_exception(e)
+
+def _apply_scheduled(prepared: Tuple[str, str], estilo: str, file_id: str) -> Dict[str, Any]:
+    """Aplicação vinda da agenda: os arquivos já estão convertidos no cache local."""
+    t0 = time.perf_counter()
+    if APPLY_QUEUE.superseded():
+        return _superseded_result({"estilo": estilo}, file_id)
+    if not WinWP.set_prepared(*prepared, estilo, file_id):
+        raise RuntimeError("Falha ao alterar o papel de parede")
+    duration_ms = round((time.perf_counter() - t0) * 1000, 1)
+    mark_wallpaper_used(file_id)  # depois da troca: rede fora do caminho crítico
+    STATUS_HUB.poke()
+    logger.info("Aplicação de papel de parede: %s", "agendada", extra={
+        "route": "/agendamento", "file_id": file_id, "outcome": "sucesso", "duration_ms": duration_ms})
+    return {"status":"sucesso","mensagem":"Papel de parede agendado aplicado","file_id":file_id,"estilo":estilo,
+            "bmp_path":WinWP.last_bmp_path,"duration_ms":duration_ms}
+
+def _superseded_result(job: Dict[str, Any], file_id: Optional[str] = None) -> Dict[str, Any]:
+    return {"status":"substituido","mensagem":"Substituído por uma alteração mais recente","file_id":file_id,"estilo":job.get("estilo")}
+
+def _apply_wallpaper(data: bytes, estilo: str, filename: str, content_type: str, sha: Optional[str] = None,
+                     keep_original: Optional[bool] = None, reuse_similar: bool = False) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    res = _apply_wallpaper_steps(data, estilo, filename, content_type, sha, keep_original, reuse_similar)
+    outcome = "noop" if res.get("noop") else res["status"]
+    logger.info("Aplicação de papel de parede: %s", outcome, extra={
+        "route": "/alterar_papel_de_parede", "file_id": res.get("file_id"), "outcome": outcome,
+        "duration_ms": round((time.perf_counter() - t0) * 1000, 1)})
+    return res
+
+def _apply_wallpaper_steps(data: bytes, estilo: str, filename: str, content_type: str, sha: Optional[str] = None,
+                           keep_original: Optional[bool] = None, reuse_similar: bool = False) -> Dict[str, Any]:
+    sha = sha or _compute_sha256(data)
+    existing = find_img_by_sha(sha)
+    similar = None
+    if not existing and reuse_similar:
+        # quase-duplicata já armazenada: não grava outra cópia, só aponta para ela
+        similar = find_similar(data)
+        if similar: existing = similar[0]
+    cur_id, cur_estilo = _current_wallpaper_state()
+    if existing and existing == cur_id and estilo == cur_estilo:
+        # mesma imagem e estilo já ativos: nada a converter/gravar
+        mark_wallpaper_used(existing)
+        return {"status":"sucesso","mensagem":"Papel de parede já estava aplicado","file_id":existing,"estilo":estilo,
+                "bmp_path":WinWP.last_bmp_path or _default_bmp_path(),"noop":True, **_similar_view(similar)}
+
+    file_id = existing or store_wallpaper(data, filename, content_type, sha=sha, keep_original=keep_original)
+    if APPLY_QUEUE.superseded():
+        return _superseded_result({"estilo": estilo}, file_id)
+
+    if not WinWP.set_wallpaper(data, estilo, file_id):
+        raise HTTPException(status_code=500, detail="Falha ao alterar o papel de parede")
+    mark_wallpaper_used(file_id)
+    STATUS_HUB.poke()
+    return {"status":"sucesso","mensagem":"Papel de parede alterado com sucesso!","file_id":file_id,"estilo":estilo,
+            "bmp_path":WinWP.last_bmp_path, **_similar_view(similar)}
+
+def _similar_view(similar: Optional[Tuple[str, int]]) -> Dict[str, Any]:
+    return {"similar": {"file_id": similar[0], "distancia": similar[1]}} if similar else {}
+
+APPLY_QUEUE = ApplyQueue()
+
 def get_current_wallpaper() -> Tuple[str,str,str]:
     try:
-        import winreg
+        winreg = PLATFORM.winreg()
         k = winreg.OpenKey(winreg.HKEY_CURRENT_USER,"Control Panel\\Desktop",0,winreg.KEY_READ)
         try: path = winreg.QueryValueEx(k,"Wallpaper")[0]; info = f"Arquivo local: {path}" if path else "Nenhum"
         except: info, path = "Não foi possível obter", ""
@@ -480,7 +1291,7 @@ def get_current_wallpaper() -> Tuple[str,str,str]:
         except: last = ""
         k.Close(); return info, mid, last
     except Exception as e:
-        logger.warning(f"Registro: {e}")
+        logger.warning("Registro: %s", e, extra={"rate_key": "registry_read"})
         return "Não foi possível obter informações do papel de parede","", ""
 
 # ============== WOL / UTILS ==============
@@ -488,7 +1299,7 @@ def get_current_wallpaper() -> Tuple[str,str,str]:
 def macs() -> List[str]:
     out = []
     try:
-        r = subprocess.run(["getmac","/fo","csv","/v"], capture_output=True, text=True, timeout=5)
+        r = PLATFORM.run(["getmac","/fo","csv","/v"], timeout=5)
         if r.returncode==0 and r.stdout:
             lines=[l for l in (x.strip() for x in r.stdout.splitlines()) if l]
             rdr = csv.reader(lines); hdr = next(rdr,[])
@@ -514,10 +1325,314 @@ def send_magic_packet(mac: str, broadcast: str='255.255.255.255', port:int=9):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
     s.sendto(data, (broadcast, port)); s.close()
 
+# ============== STATUS / STREAM (SSE) ==============
+
+def _mongo_ping() -> bool:
+    try: DBI.client.admin.command("ping"); return True
+    except Exception as e:
+        logger.warning("Mongo ping: %s", e, extra={"rate_key": "mongo_ping"})
+        return False
+
+def _wallpaper_block(info: str, mid: str, last: str) -> Dict[str, Any]:
+    wall = {"info": info, "last_changed": last or "Desconhecido"}
+    if mid:
+        wall["file_id"] = mid
+        try:
+            db = DBI.client[S.DB_NAME]
+            f = db[f"{S.WALLPAPER_COLLECTION}.files"].find_one({"_id": ObjectId(mid)}, {"filename": 1})
+            if f and f.get("filename"): wall["file_name"] = f["filename"]
+        except: pass
+    return wall
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+class StatusHub:
+    """Distribui mudanças de estado para os ouvintes de /obter_status/stream.
+    Um único watcher roda só enquanto houver ouvintes e faz apenas verificações baratas
+    (Registro, disk_usage, ping); o snapshot completo é enviado uma vez por conexão.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._subs: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = {}
+        self._seq = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self) -> Tuple[int, asyncio.Queue]:
+        q: asyncio.Queue = asyncio.Queue(maxsize=64)
+        with self._lock:
+            self._seq += 1; sid = self._seq
+            self._subs[sid] = (asyncio.get_running_loop(), q)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name="status-hub", daemon=True)
+                self._thread.start()
+        return sid, q
+
+    def unsubscribe(self, sid: int):
+        with self._lock:
+            self._subs.pop(sid, None)
+        if not self._subs: self._wake.set()
+
+    def poke(self):
+        """Força uma verificação imediata (ex.: após aplicar um papel de parede)."""
+        self._wake.set()
+
+    def publish(self, event: str, data: Dict[str, Any]):
+        with self._lock:
+            subs = list(self._subs.values())
+        for loop, q in subs:
+            try: loop.call_soon_threadsafe(self._offer, q, (event, data))
+            except RuntimeError: pass  # loop encerrado
+
+    @staticmethod
+    def _offer(q: asyncio.Queue, item):
+        try: q.put_nowait(item)
+        except asyncio.QueueFull: pass  # ouvinte lento: descarta, o próximo snapshot corrige
+
+    @staticmethod
+    def _probe() -> Dict[str, Any]:
+        info, mid, last = get_current_wallpaper()
+        try: free_gb = _bytes_to_gb(_disk_usage()[2])
+        except: free_gb = None
+        return {
+            "wallpaper": (info, mid, last),
+            "storage_free_gb": free_gb,
+            "disk_low": free_gb is not None and free_gb < S.DISK_LOW_GB,
+            "mongo_connected": _mongo_ping(),
+        }
+
+    def _run(self):
+        prev = self._probe()
+        while True:
+            self._wake.wait(S.STATUS_WATCH_INTERVAL); self._wake.clear()
+            with self._lock:
+                if not self._subs:
+                    self._thread = None
+                    return
+            try:
+                cur = self._probe()
+                if cur["wallpaper"] != prev["wallpaper"]:
+                    self.publish("wallpaper", {"wallpaper": _wallpaper_block(*cur["wallpaper"])})
+                if cur["disk_low"] != prev["disk_low"]:
+                    self.publish("disk", {"disk_low": cur["disk_low"], "hardware": {"storage_free_gb": cur["storage_free_gb"]}})
+                if cur["mongo_connected"] != prev["mongo_connected"]:
+                    self.publish("mongo", {"mongo_connected": cur["mongo_connected"]})
+                prev = cur
+            except Exception as e:
+                logger.warning("StatusHub: %s", e, extra={"rate_key": "status_hub"})
+
+STATUS_HUB = StatusHub()
+
+# ============== MÉTRICAS (série histórica) ==============
+
+METRIC_NAMES = ("disk_free_gb", "mem_load_pct", "cpu_load_pct")
+
+class _Ring:
+    """Série de tamanho fixo em arrays: timestamps + uma coluna float32 por métrica."""
+    def __init__(self, size: int, step: int):
+        self.size, self.step = size, step
+        self.ts = array('d', [0.0]) * size
+        self.cols = [array('f', [0.0]) * size for _ in METRIC_NAMES]
+        self.pos = 0; self.count = 0
+
+    def append(self, ts: float, vals):
+        i = self.pos
+        self.ts[i] = ts
+        for col, v in zip(self.cols, vals): col[i] = v
+        self.pos = (i + 1) % self.size; self.count = min(self.count + 1, self.size)
+
+    def query(self, since: float = 0.0) -> Dict[str, List[Any]]:
+        start = (self.pos - self.count) % self.size
+        idx = [(start + k) % self.size for k in range(self.count)]
+        idx = [i for i in idx if self.ts[i] >= since]
+        out: Dict[str, List[Any]] = {"ts": [int(self.ts[i]) for i in idx]}
+        for name, col in zip(METRIC_NAMES, self.cols):
+            out[name] = [None if math.isnan(col[i]) else round(col[i], 2) for i in idx]
+        return out
+
+class MetricsHistory:
+    """Amostras brutas a cada METRICS_INTERVAL (1h), médias de 5 min (24h) e horárias (30 dias).
+    Tudo em arrays pré-alocados: o consumo de memória não cresce com o tempo de execução.
+    """
+    def __init__(self, interval: int):
+        self._lock = threading.Lock()
+        self.tiers = {"raw": _Ring(max(1, 3600 // interval), interval), "5m": _Ring(288, 300), "1h": _Ring(24 * 30, 3600)}
+        self._acc: Dict[str, list] = {}  # tier -> [início do balde, contagens, somas]
+        self._prev_cpu: Optional[Tuple[float, float]] = None
+
+    def add(self, ts: float, vals):
+        with self._lock:
+            self.tiers["raw"].append(ts, vals)
+            self._roll("5m", ts, vals)
+
+    def _roll(self, tier: str, ts: float, vals):
+        ring = self.tiers[tier]
+        bucket = ts - ts % ring.step
+        acc = self._acc.get(tier)
+        if acc and acc[0] != bucket:
+            avg = [t / n if n else float("nan") for n, t in zip(acc[1], acc[2])]
+            ring.append(acc[0], avg)
+            if tier == "5m": self._roll("1h", acc[0], avg)
+            acc = None
+        if acc is None:
+            acc = self._acc[tier] = [bucket, [0] * len(METRIC_NAMES), [0.0] * len(METRIC_NAMES)]
+        for i, v in enumerate(vals):
+            if not math.isnan(v):  # métrica indisponível não entra na média
+                acc[1][i] += 1; acc[2][i] += v
+
+    def query(self, tier: str, since: float = 0.0) -> Dict[str, Any]:
+        with self._lock:
+            ring = self.tiers[tier]
+            return {"tier": tier, "step_s": ring.step, "capacity": ring.size, **ring.query(since)}
+
+    def sample(self):
+        nan = float("nan")
+        try: disk = _bytes_to_gb(_disk_usage()[2])
+        except: disk = nan
+        try: mem = _memory_status()[1]
+        except: mem = nan
+        cpu, cur = nan, _cpu_times()
+        if cur and self._prev_cpu and cur[1] > self._prev_cpu[1]:
+            d_idle, d_total = cur[0] - self._prev_cpu[0], cur[1] - self._prev_cpu[1]
+            cpu = 100.0 * (1.0 - d_idle / d_total)
+        self._prev_cpu = cur
+        self.add(time.time(), (disk, mem, cpu))
+
+METRICS = MetricsHistory(S.METRICS_INTERVAL)
+
 # ============== FASTAPI ==============
 
 app = FastAPI(title="Wallpaper Agent API", version="1.0.0", description="API para gerenciamento de papel de parede")
 
+_MULTIPART_SLACK = 64 * 1024  # boundary + campos do formulário além do arquivo
+
+@app.middleware("http")
+async def _upload_size_guard(request: Request, call_next):
+    """Recusa pelo Content-Length o upload multipart grande demais. O Starlette lê e faz spool
+    do corpo inteiro antes do handler rodar, então esta é a única checagem que evita receber
+    o arquivo; sem Content-Length (chunked) vale a checagem do handler depois da leitura."""
+    if request.method == "POST" and request.url.path == "/alterar_papel_de_parede":
+        try: length = int(request.headers.get("content-length") or -1)
+        except ValueError: length = -1
+        if length > S.UPLOAD_MAX_MB * 1024 * 1024 + _MULTIPART_SLACK:
+            err = ADMISSION.reject("bytes", length, 413, f"Arquivo maior que {S.UPLOAD_MAX_MB} MB")
+            return JSONResponse({"detail": err.detail}, status_code=err.status_code, headers={"Connection": "close"})
+    return await call_next(request)
+
+@app.middleware("http")
+async def _access_log(request: Request, call_next):
+    t0 = time.perf_counter()
+    outcome: Any = "exception"
+    try:
+        resp = await call_next(request)
+        outcome = resp.status_code
+        return resp
+    finally:
+        # GET bem-sucedido (polling) só aparece em DEBUG; o resto em INFO
+        lvl = logging.DEBUG if request.method == "GET" and isinstance(outcome, int) and outcome < 400 else logging.INFO
+        if logger.isEnabledFor(lvl):
+            route = getattr(request.scope.get("route"), "path", request.url.path)
+            logger.log(lvl, "%s %s -> %s", request.method, route, outcome, extra={
+                "route": route, "method": request.method, "outcome": outcome,
+                "file_id": request.path_params.get("file_id"),
+                "duration_ms": round((time.perf_counter() - t0) * 1000, 1)})
+
+# ============== NEGOCIAÇÃO DE CONTEÚDO / COMPRESSÃO ==============
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+_COMPRESSIBLE = ("application/json", "application/msgpack", "application/x-msgpack", "text/plain", "text/csv", "text/html")
+
+def _accepted_encodings(header: str) -> set:
+    """Codificações aceitas no Accept-Encoding (as com q=0 ficam de fora)."""
+    out = set()
+    for part in (header or "").split(","):
+        name, *params = [x.strip() for x in part.split(";")]
+        q = 1.0
+        for prm in params:
+            if prm.startswith("q="):
+                try: q = float(prm[2:])
+                except ValueError: q = 0.0
+        if name and q > 0: out.add(name.lower())
+    return out
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br": return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+class CompressionMiddleware:
+    """gzip/br para respostas compressíveis a partir de COMPRESS_MIN_BYTES.
+    Imagens (já comprimidas) e o SSE (text/event-stream) passam direto; o corpo
+    das demais é juntado e comprimido de uma vez, em thread quando é grande."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") == "HEAD":
+            return await self.app(scope, receive, send)
+        headers = dict((k.decode("latin-1").lower(), v.decode("latin-1")) for k, v in scope.get("headers") or [])
+        accepted = _accepted_encodings(headers.get("accept-encoding", ""))
+        encoding = "br" if brotli and "br" in accepted else "gzip" if "gzip" in accepted else None
+        if not encoding:
+            return await self.app(scope, receive, send)
+
+        start: Optional[Dict[str, Any]] = None
+        chunks: List[bytes] = []
+        passthrough = False
+
+        async def _send(message):
+            nonlocal start, passthrough
+            if message["type"] == "http.response.start":
+                hdrs = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in message.get("headers", [])}
+                ctype = hdrs.get("content-type", "").split(";")[0].strip()
+                passthrough = "content-encoding" in hdrs or ctype not in _COMPRESSIBLE
+                if passthrough: return await send(message)
+                start = message; return
+            if passthrough or message["type"] != "http.response.body":
+                return await send(message)
+            chunks.append(message.get("body", b""))
+            if message.get("more_body"): return
+            body = b"".join(chunks)
+            raw = [(k, v) for k, v in start.get("headers", []) if k.lower() not in (b"content-length", b"vary")]
+            vary = [v.decode("latin-1") for k, v in start.get("headers", []) if k.lower() == b"vary"]
+            if len(body) >= S.COMPRESS_MIN_BYTES:
+                body = await run_in_threadpool(_compress, body, encoding) if len(body) > 256 * 1024 else _compress(body, encoding)
+                raw.append((b"content-encoding", encoding.encode()))
+                vary.append("Accept-Encoding")
+            if vary: raw.append((b"vary", ", ".join(vary).encode("latin-1")))
+            raw.append((b"content-length", str(len(body)).encode()))
+            await send({**start, "headers": raw})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, _send)
+
+def _select_fields(data: Dict[str, Any], spec: Optional[str]) -> Dict[str, Any]:
+    """`?fields=status,wallpaper.file_id,hardware.cpu` — caminhos com ponto; campos
+    desconhecidos são ignorados."""
+    if not spec: return data
+    out: Dict[str, Any] = {}
+    for path in (p.strip() for p in spec.split(",")):
+        if not path: continue
+        src, dst = data, out
+        keys = path.split(".")
+        for i, k in enumerate(keys):
+            if not isinstance(src, dict) or k not in src: break
+            if i == len(keys) - 1: dst[k] = src[k]; break
+            src = src[k]
+            dst = dst.setdefault(k, {})
+            if not isinstance(dst, dict): break
+    return out
+
+def negotiate(request: Request, data: Dict[str, Any], fields: Optional[str] = None) -> Response:
+    """JSON ou MessagePack (Accept) com seleção de campos; a compressão fica no middleware."""
+    data = _select_fields(data, fields)
+    accept = request.headers.get("accept", "")
+    if msgpack and any(t in accept for t in MSGPACK_TYPES):
+        return Response(msgpack.packb(jsonable_encoder(data), use_bin_type=True), media_type="application/msgpack",
+                        headers={"Vary": "Accept"})
+    return JSONResponse(data, headers={"Vary": "Accept"})
+
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=False, allow_methods=["*"], allow_headers=["*"])
 
 MACHINE_CODE = get_or_create_machine_code()
@@ -559,32 +1674,27 @@ def set_user(user_id: str, agent_key: Optional[str] = None):
 
 @app.get("/")
 def root():
-    return {"message":"Wallpaper Agent API está rodando!","endpoints":{"test_cors":"/test-cors","obter_status":"/obter_status","alterar_papel_de_parede":"/alterar_papel_de_parede"},"status":"online","timestamp":datetime.datetime.now().isoformat()}
+    return {"message":"Wallpaper Agent API está rodando!","endpoints":{"test_cors":"/test-cors","obter_status":"/obter_status","obter_status_stream":"/obter_status/stream","alterar_papel_de_parede":"/alterar_papel_de_parede"},"status":"online","timestamp":datetime.datetime.now().isoformat()}
 
 @app.get("/test-cors")
 def test_cors(): return {"message":"CORS está funcionando!"}
 
 @app.get("/wallpaper/{file_id}")
 def get_wallpaper(file_id: str):
-    obj = read_img(file_id)
+    obj = FLIGHT.do(f"file:{file_id}", read_img, file_id)
     return Response(content=obj["data"], media_type=obj["content_type"], headers={"Cache-Control":"public, max-age=31536000"})
 
-@app.get("/obter_status")
-def obter_status(request: Request):
+def _base_url(request: Request) -> str:
+    scheme = request.url.scheme or "http"
+    host = request.headers.get("host") or f"{getattr(request.client,'host','localhost')}:{S.PORT}"
+    return f"{scheme}://{host}"
+
+def _status_payload(base_url: str) -> Dict[str, Any]:
     info, mid, last = get_current_wallpaper()
-    mongo_ok = False
-    try: DBI.client.admin.command("ping"); mongo_ok=True
-    except Exception as e: logger.warning(f"Mongo ping: {e}")
+    mongo_ok = _mongo_ping()
 
-    wall = {"info":info, "last_changed": last or "Desconhecido"}
-    if mid:
-        try:
-            scheme = request.url.scheme or "http"
-            host = request.headers.get("host") or f"{getattr(request.client,'host','localhost')}:{S.PORT}"
-            wall["image_url"] = f"{scheme}://{host}/wallpaper/{mid}"
-            f = DBI.fs.get(ObjectId(mid))
-            if getattr(f,'filename',None): wall["file_name"]=f.filename
-        except: pass
+    wall = _wallpaper_block(info, mid, last)
+    if mid: wall["image_url"] = f"{base_url}/wallpaper/{mid}"
 
     sysi = system_info(S.PORT)
     return {
@@ -598,6 +1708,54 @@ def obter_status(request: Request):
         }
     }
 
+@app.get("/obter_status")
+def obter_status(request: Request, fields: Optional[str] = None):
+    """Status completo; `?fields=` limita os campos e `Accept: application/msgpack` troca a codificação."""
+    base = _base_url(request)
+    return negotiate(request, FLIGHT.do(f"status:{base}", _status_payload, base), fields)
+
+@app.get("/obter_status/stream")
+async def obter_status_stream(request: Request):
+    """Server-Sent Events: envia o status completo uma vez ("snapshot") e depois apenas
+    diferenças ("wallpaper", "disk", "mongo"). Substitui o polling do dashboard.
+    """
+    base = _base_url(request)
+    sid, q = STATUS_HUB.subscribe()
+
+    async def _events():
+        try:
+            yield f"retry: {S.STATUS_RETRY_S * 1000}\n\n"
+            yield _sse("snapshot", await run_in_threadpool(FLIGHT.do, f"status:{base}", _status_payload, base))
+            while not await request.is_disconnected():
+                try:
+                    event, data = await asyncio.wait_for(q.get(), timeout=S.STATUS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event == "wallpaper" and data["wallpaper"].get("file_id"):
+                    wall = {**data["wallpaper"], "image_url": f"{base}/wallpaper/{data['wallpaper']['file_id']}"}
+                    data = {**data, "wallpaper": wall}
+                yield _sse(event, data)
+        finally:
+            STATUS_HUB.unsubscribe(sid)
+
+    return StreamingResponse(_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/metrics/history")
+def metrics_history(tier: str = "raw", since: float = 0.0):
+    """Histórico local de disco livre, uso de memória e CPU. `tier`: raw | 5m | 1h; `since`: epoch (s)."""
+    if tier not in METRICS.tiers:
+        raise HTTPException(status_code=400, detail="tier inválido. Use: " + ", ".join(METRICS.tiers))
+    return {"metrics": list(METRIC_NAMES), **METRICS.query(tier, since)}
+
+@app.get("/metrics/admission")
+def metrics_admission():
+    """Aceites/rejeições da admissão de imagens (por motivo) e os limites em vigor."""
+    return {**ADMISSION.snapshot(), "limits": {
+        "max_bytes": S.UPLOAD_MAX_MB * 1024 * 1024, "max_pixels": S.IMG_MAX_PIXELS,
+        "formats": _allowed_formats(), "decode_max_side": S.IMG_DECODE_MAX_SIDE}}
+
 @app.post("/wol")
 def wake_on_lan(mac: str = Form(...)):
     send_magic_packet(mac)
@@ -606,29 +1764,35 @@ def wake_on_lan(mac: str = Form(...)):
 @app.post("/shutdown")
 def shutdown_machine(x_agent_key: Optional[str] = None):
     require_key(x_agent_key)
-    r = subprocess.run(["shutdown","/s","/t","0"], capture_output=True, text=True)
+    r = PLATFORM.run(["shutdown","/s","/t","0"])
     if r.returncode!=0: raise HTTPException(status_code=500, detail=r.stderr or "Falha ao executar shutdown")
     return {"ok": True, "message": "Comando de desligar enviado"}
 
 @app.post("/alterar_papel_de_parede")
-async def alterar_papel_de_parede(file: UploadFile = File(...), estilo: str = Form(...), x_agent_key: Optional[str] = None):
+async def alterar_papel_de_parede(file: UploadFile = File(...), estilo: str = Form(...), manter_original: Optional[bool] = Form(None),
+                                  reaproveitar_similar: bool = Form(False), x_agent_key: Optional[str] = None):
     require_key(x_agent_key)
     if not (file.content_type or "").startswith("image/"):
         raise HTTPException(status_code=400, detail="O arquivo deve ser uma imagem")
-    if estilo not in ["preencher","ajustar","estender","ladrilhar","centralizar","esticar"]:
+    if estilo not in ESTILOS:
         raise HTTPException(status_code=400, detail="Estilo inválido. Use: preencher, ajustar, estender, ladrilhar, centralizar ou esticar")
     try:
-        data = await file.read()
-        if not data: raise HTTPException(status_code=400, detail="Arquivo vazio")
-
-        file_id = save_img_dedup(data, filename=file.filename or "wallpaper.jpg", content_type=file.content_type or "image/jpeg")
-
-        WinWP.last_file_id = file_id
-        if WinWP.set_wallpaper(data, estilo):
-            mark_wallpaper_used(file_id)
-            bmp_used = WinWP.last_bmp_path
-            return {"status":"sucesso","mensagem":"Papel de parede alterado com sucesso!","file_id":file_id,"estilo":estilo,"bmp_path":bmp_used}
-        raise HTTPException(status_code=500, detail="Falha ao alterar o papel de parede")
+        # o corpo já está no spool do Starlette (o tamanho declarado foi barrado em
+        # _upload_size_guard); a admissão pelo cabeçalho evita decodificar/gravar o resto
+        head = await file.read(SNIFF_BYTES)
+        if not head: raise HTTPException(status_code=400, detail="Arquivo vazio")
+        admitted = admit_image(head, file.size, final=False)
+        if admitted is None:
+            head += await file.read(SNIFF_MAX_BYTES - len(head))
+            admit_image(head, file.size)
+        data = head + await file.read()
+        if len(data) > S.UPLOAD_MAX_MB * 1024 * 1024:
+            raise ADMISSION.reject("bytes", len(data), 413, f"Arquivo maior que {S.UPLOAD_MAX_MB} MB")
+
+        fut = APPLY_QUEUE.submit(data=data, estilo=estilo, filename=file.filename or "wallpaper.jpg",
+                                 content_type=file.content_type or "image/jpeg", keep_original=manter_original,
+                                 reuse_similar=reaproveitar_similar)
+        return await asyncio.wrap_future(fut)
     except HTTPException: raise
     except Exception as e:
         logger.exception("Erro ao processar o arquivo")
@@ -637,100 +1801,629 @@ async def alterar_papel_de_parede(file: UploadFile = File(...), estilo: str = Fo
         try: await file.close()
         except: pass
 
+# ============== UPLOAD RETOMÁVEL ==============
+# POST /uploads (cria sessão) -> PUT /uploads/{id}?offset=N (pedaços) -> GET /uploads/{id}
+# (progresso, para retomar) -> POST /uploads/{id}/finalize (confere sha256, grava via dedupe
+# e, se vier `estilo`, aplica). Cancelamento: DELETE /uploads/{id}.
+
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+
+def _upload_dir() -> str:
+    appdata = os.getenv('APPDATA') or os.path.expanduser('~')
+    d = os.path.join(appdata, 'WallpaperAgent', 'uploads'); os.makedirs(d, exist_ok=True)
+    return d
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b""): h.update(block)
+    return h.hexdigest()
+
+class UploadSessions:
+    """Sessões no spool local: <id>.json (metadados) + <id>.part (bytes recebidos).
+    O progresso é o tamanho do .part, então a retomada sobrevive a reinícios do agente.
+    """
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _paths(self, uid: str) -> Tuple[str, str]:
+        d = _upload_dir()
+        return os.path.join(d, f"{uid}.json"), os.path.join(d, f"{uid}.part")
+
+    def lock(self, uid: str) -> asyncio.Lock:
+        if not _UPLOAD_ID.match(uid or ""): raise HTTPException(status_code=404, detail="Sessão de upload não encontrada")
+        return self._locks.setdefault(uid, asyncio.Lock())
+
+    def create(self, filename: str, content_type: str, size: int, sha256: Optional[str]) -> Dict[str, Any]:
+        self.sweep()
+        uid = uuid.uuid4().hex
+        meta = {"upload_id": uid, "filename": filename, "content_type": content_type, "size": size,
+                "sha256": sha256, "created_at": time.time()}
+        meta_path, part_path = self._paths(uid)
+        open(part_path, 'wb').close()
+        self.touch(meta)
+        return {**meta, "received": 0}
+
+    def get(self, uid: str) -> Dict[str, Any]:
+        if not _UPLOAD_ID.match(uid or ""): raise HTTPException(status_code=404, detail="Sessão de upload não encontrada")
+        meta_path, part_path = self._paths(uid)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f: meta = json.load(f)
+            received = os.path.getsize(part_path)
+        except (FileNotFoundError, ValueError):
+            raise HTTPException(status_code=404, detail="Sessão de upload não encontrada")
+        if meta.get("expires_at", 0) < time.time():
+            self.remove(uid)
+            raise HTTPException(status_code=410, detail="Sessão de upload expirada")
+        return {**meta, "received": received}
+
+    def touch(self, meta: Dict[str, Any]):
+        """Grava os metadados renovando a expiração (chamado a cada pedaço recebido)."""
+        meta["expires_at"] = time.time() + S.UPLOAD_SESSION_TTL_H * 3600
+        meta = {k: v for k, v in meta.items() if k != "received"}
+        meta_path, _ = self._paths(meta["upload_id"])
+        tmp = meta_path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f: json.dump(meta, f)
+        os.replace(tmp, meta_path)
+
+    def part_path(self, uid: str) -> str:
+        return self._paths(uid)[1]
+
+    def remove(self, uid: str):
+        for p in self._paths(uid):
+            try: os.remove(p)
+            except FileNotFoundError: pass
+            except Exception as e: logger.warning("Upload %s: falha ao remover %s: %s", uid, p, e)
+        self._locks.pop(uid, None)
+
+    def sweep(self):
+        """Remove sessões abandonadas (expiradas) do spool."""
+        now = time.time()
+        try: names = os.listdir(_upload_dir())
+        except Exception: return
+        for name in names:
+            if not name.endswith(".json"): continue
+            uid = name[:-5]
+            try:
+                with open(os.path.join(_upload_dir(), name), 'r', encoding='utf-8') as f:
+                    expired = json.load(f).get("expires_at", 0) < now
+            except Exception:
+                expired = True
+            if expired:
+                logger.info("Upload %s expirado: removendo do spool", uid)
+                self.remove(uid)
+
+UPLOADS = UploadSessions()
+
+def _admit_upload(meta: Dict[str, Any], received: int, force: bool = False) -> None:
+    """Admissão do upload retomável assim que o cabeçalho chega (normalmente no 1º pedaço);
+    rejeitado, a sessão é descartada antes de receber o resto. `force` ignora a marca
+    `admitted` e confere de novo o que está no spool (usado no finalize)."""
+    if (meta.get("admitted") and not force) or (received < SNIFF_BYTES and received < meta["size"]):
+        return
+    with open(UPLOADS.part_path(meta["upload_id"]), 'rb') as f:
+        head = f.read(SNIFF_MAX_BYTES)
+    final = received >= meta["size"] or received >= SNIFF_MAX_BYTES
+    try:
+        info = admit_image(head, meta["size"], final=final)
+    except HTTPException:
+        UPLOADS.remove(meta["upload_id"])
+        raise
+    if info: meta.update(admitted=True, image=info)
+
+def _upload_view(meta: Dict[str, Any]) -> Dict[str, Any]:
+    return {"upload_id": meta["upload_id"], "received": meta["received"], "size": meta["size"],
+            "complete": meta["received"] == meta["size"], "chunk_size": S.UPLOAD_CHUNK_KB * 1024,
+            "expires_at": datetime.datetime.fromtimestamp(meta.get("expires_at", time.time()), datetime.timezone.utc).isoformat()}
+
+@app.post("/uploads")
+async def upload_create(request: Request, x_agent_key: Optional[str] = None):
+    """Cria uma sessão de upload retomável.
+    Body JSON: { "filename": "a.jpg", "content_type": "image/jpeg", "size": 12345, "sha256": "<opcional>" }
+    """
+    require_key(x_agent_key)
+    try: data = await request.json()
+    except Exception: raise HTTPException(status_code=400, detail="Body JSON inválido")
+    content_type = str(data.get("content_type") or "")
+    if not content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="O arquivo deve ser uma imagem")
+    try: size = int(data.get("size"))
+    except Exception: raise HTTPException(status_code=400, detail="Campo 'size' obrigatório (bytes)")
+    if size <= 0: raise HTTPException(status_code=400, detail="Arquivo vazio")
+    if size > S.UPLOAD_MAX_MB * 1024 * 1024:
+        raise ADMISSION.reject("bytes", size, 413, f"Arquivo maior que {S.UPLOAD_MAX_MB} MB")
+    sha = data.get("sha256")
+    if sha is not None and not re.fullmatch(r"[0-9a-fA-F]{64}", str(sha)):
+        raise HTTPException(status_code=400, detail="sha256 inválido")
+    meta = await run_in_threadpool(UPLOADS.create, str(data.get("filename") or "wallpaper.jpg"), content_type, size,
+                                   sha.lower() if sha else None)
+    return _upload_view(UPLOADS.get(meta["upload_id"]))
+
+@app.get("/uploads/{upload_id}")
+def upload_progress(upload_id: str, x_agent_key: Optional[str] = None):
+    """Progresso da sessão: o cliente retoma a partir de `received`."""
+    require_key(x_agent_key)
+    return _upload_view(UPLOADS.get(upload_id))
+
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, offset: int, x_agent_key: Optional[str] = None):
+    """Grava o corpo da requisição a partir de `offset` (bytes crus, sem multipart).
+    `offset` menor que o já recebido sobrescreve (reenvio); maior retorna 409 com o progresso.
+    O corpo vai direto para o spool em blocos; se a conexão cair, o que chegou fica salvo.
+    """
+    require_key(x_agent_key)
+    async with UPLOADS.lock(upload_id):
+        meta = UPLOADS.get(upload_id)
+        if offset < 0 or offset > meta["received"]:
+            raise HTTPException(status_code=409, detail=f"offset inválido; recebido até {meta['received']}",
+                                headers={"Upload-Offset": str(meta["received"])})
+        if offset < SNIFF_MAX_BYTES and meta.get("admitted"):
+            # reenvio que reescreve o cabeçalho: a admissão anterior não vale mais
+            meta.pop("admitted", None); meta.pop("image", None)
+            UPLOADS.touch(meta)
+        written = offset; buf = bytearray()
+        f = open(UPLOADS.part_path(upload_id), 'r+b')
+        try:
+            f.truncate(offset); f.seek(offset)
+            async for piece in request.stream():
+                if written + len(buf) + len(piece) > meta["size"]:
+                    raise HTTPException(status_code=413, detail="Pedaço ultrapassa o tamanho declarado")
+                buf += piece
+                if len(buf) >= 256 * 1024:
+                    await run_in_threadpool(f.write, bytes(buf)); written += len(buf); buf.clear()
+            if buf:
+                await run_in_threadpool(f.write, bytes(buf)); written += len(buf)
+        finally:
+            f.close()
+        await run_in_threadpool(_admit_upload, meta, written)
+        UPLOADS.touch(meta)
+        return _upload_view({**meta, "received": written})
+
+@app.post("/uploads/{upload_id}/finalize")
+async def upload_finalize(upload_id: str, estilo: Optional[str] = Form(None), manter_original: Optional[bool] = Form(None),
+                          reaproveitar_similar: bool = Form(False), x_agent_key: Optional[str] = None):
+    """Confere tamanho e sha256, grava no GridFS pelo caminho de dedupe e, com `estilo`, aplica.
+    Com `reaproveitar_similar`, uma quase-duplicata já armazenada é usada no lugar do arquivo novo."""
+    require_key(x_agent_key)
+    if estilo is not None and estilo not in ESTILOS:
+        raise HTTPException(status_code=400, detail="Estilo inválido. Use: " + ", ".join(ESTILOS))
+    async with UPLOADS.lock(upload_id):
+        meta = UPLOADS.get(upload_id)
+        if meta["received"] != meta["size"]:
+            raise HTTPException(status_code=409, detail=f"Upload incompleto: {meta['received']}/{meta['size']} bytes",
+                                headers={"Upload-Offset": str(meta["received"])})
+        # sempre reconfere o cabeçalho do que está no spool, não só a marca da sessão
+        await run_in_threadpool(_admit_upload, meta, meta["received"], True)
+        part = UPLOADS.part_path(upload_id)
+        sha = await run_in_threadpool(_sha256_file, part)
+        if meta.get("sha256") and sha != meta["sha256"]:
+            UPLOADS.remove(upload_id)
+            raise HTTPException(status_code=422, detail="sha256 não confere; reenvie o arquivo")
+
+        def _commit() -> Tuple[str, Optional[Tuple[str, int]]]:
+            with open(part, 'rb') as f:
+                existing = find_img_by_sha(sha)
+                if existing: return existing, None
+                similar = find_similar(f) if reaproveitar_similar else None
+                if similar: return similar[0], similar
+                if S.CANON_ENABLED:  # re-encode precisa dos bytes
+                    return store_wallpaper(f.read(), meta["filename"], meta["content_type"], sha=sha, keep_original=manter_original), None
+                return save_img_dedup(f, meta["filename"], meta["content_type"], sha=sha, size=meta["size"]), None
+        try:
+            file_id, similar = await run_in_threadpool(_commit)
+            res: Dict[str, Any] = {"status": "sucesso", "upload_id": upload_id, "file_id": file_id, "sha256": sha, "bytes": meta["size"],
+                                   **_similar_view(similar)}
+            if estilo:
+                with open(part, 'rb') as f: data = await run_in_threadpool(f.read)
+                fut = APPLY_QUEUE.submit(data=data, estilo=estilo, filename=meta["filename"],
+                                         content_type=meta["content_type"], sha=sha, keep_original=manter_original,
+                                         reuse_similar=reaproveitar_similar)
+                res.update(await asyncio.wrap_future(fut))
+        except HTTPException: raise
+        except Exception as e:
+            logger.exception("Erro ao finalizar upload")
+            raise HTTPException(status_code=500, detail=f"Erro ao finalizar upload: {e}")
+        UPLOADS.remove(upload_id)
+        return res
+
+@app.delete("/uploads/{upload_id}")
+def upload_abort(upload_id: str, x_agent_key: Optional[str] = None):
+    require_key(x_agent_key)
+    UPLOADS.get(upload_id)
+    UPLOADS.remove(upload_id)
+    return {"ok": True}
+
+# ============== AGENDA (playlist com pré-busca) ==============
+
+def _schedule_dir() -> str:
+    appdata = os.getenv('APPDATA') or os.path.expanduser('~')
+    d = os.path.join(appdata, 'WallpaperAgent', 'agenda'); os.makedirs(d, exist_ok=True)
+    return d
+
+class WallpaperSchedule:
+    """Playlist local de papéis de parede: [{file_id, inicio (epoch), estilo}] e, opcionalmente,
+    `ciclo_h` para repetir a sequência (ex.: 5 imagens, uma por dia, ciclo de 120 h).
+    Cada imagem é baixada do GridFS e convertida para BMP/JPEG no cache local bem antes da
+    troca, num instante sorteado por máquina (jitter) para a frota não bater no Mongo junto.
+    Na hora marcada a troca usa só o cache (cópia local, Registro, SPI).
+    Uma troca manual vale até a próxima entrada da agenda.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._prefetch_at: Dict[str, float] = {}
+        self._failures: Dict[str, int] = {}
+        self.plan: Dict[str, Any] = self._load()
+
+    def _plan_path(self) -> str:
+        return os.path.join(_schedule_dir(), 'playlist.json')
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self._plan_path(), 'r', encoding='utf-8') as f: return json.load(f)
+        except FileNotFoundError: pass
+        except Exception as e: logger.warning("Agenda ilegível, ignorando: %s", e)
+        return {"itens": [], "ciclo_h": None, "aplicado": None}
+
+    def _save(self):
+        tmp = self._plan_path() + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f: json.dump(self.plan, f)
+        os.replace(tmp, self._plan_path())
+
+    def cached(self, fid: str) -> Optional[Tuple[str, str]]:
+        d = _schedule_dir()
+        bmp, jpg = os.path.join(d, f"{fid}.bmp"), os.path.join(d, f"{fid}.jpg")
+        return (bmp, jpg) if os.path.exists(bmp) and os.path.exists(jpg) else None
+
+    # ---- plano ----
+    def set(self, itens: List[Dict[str, Any]], ciclo_h: Optional[float]):
+        with self._lock:
+            self.plan = {"itens": sorted(itens, key=lambda i: i["inicio"]), "ciclo_h": ciclo_h,
+                         "aplicado": self.plan.get("aplicado"), "atualizado_em": time.time()}
+            self._save()
+            self._prefetch_at.clear(); self._failures.clear()
+        self._wake.set()
+
+    def clear(self):
+        self.set([], None)
+
+    def _occurrences(self, start: float, end: float) -> List[Tuple[float, Dict[str, Any]]]:
+        """Entradas (instante, item) em [start, end), expandindo o ciclo quando houver."""
+        itens, ciclo = self.plan["itens"], self.plan.get("ciclo_h")
+        if not itens: return []
+        if not ciclo: return [(i["inicio"], i) for i in itens if start <= i["inicio"] < end]
+        period, t0 = ciclo * 3600, itens[0]["inicio"]
+        k = max(0, math.floor((start - t0) / period))
+        out = []
+        while t0 + k * period < end:
+            out.extend((i["inicio"] + k * period, i) for i in itens if start <= i["inicio"] + k * period < end)
+            k += 1
+        return out
+
+    def current(self, now: float) -> Optional[Tuple[float, Dict[str, Any]]]:
+        """Entrada vigente: a última que já começou."""
+        itens, ciclo = self.plan["itens"], self.plan.get("ciclo_h")
+        if not itens: return None
+        past = self._occurrences(now - ciclo * 3600 if ciclo else itens[0]["inicio"], now + 0.001)
+        return past[-1] if past else None
+
+    # ---- laço ----
+    def start(self):
+        if self._thread: return
+        self._thread = threading.Thread(target=self._run, name="agenda", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try: wait = self._tick(time.time())
+            except Exception as e:
+                logger.warning("Agenda: %s", e, extra={"rate_key": "agenda"}); wait = 60
+            self._wake.wait(max(0.5, min(wait, 300)))
+
+    def _tick(self, now: float) -> float:
+        """Aplica a entrada vigente, adianta as pré-buscas vencidas e devolve quanto dormir."""
+        with self._lock:
+            cur = self.current(now)
+            upcoming = self._occurrences(now + 0.001, now + S.SCHEDULE_PREFETCH_H * 3600)
+        if cur:
+            when, item = cur
+            key = f"{when:.0f}:{item['file_id']}"
+            if self.plan.get("aplicado") != key:
+                self._activate(item, key)
+        nxt = [w for w, _ in upcoming]
+        wanted = {item["file_id"] for _, item in upcoming} | ({cur[1]["file_id"]} if cur else set())
+        for when, item in upcoming:
+            fid = item["file_id"]
+            if fid in self._prefetch_at or self.cached(fid): continue
+            # sorteia o instante da pré-busca dentro da janela que ainda termina antes da troca
+            window = max(0.0, min(S.SCHEDULE_JITTER_MIN * 60, when - S.SCHEDULE_LEAD_MIN * 60 - now))
+            self._prefetch_at[fid] = now + random.uniform(0, window)
+        for fid, at in list(self._prefetch_at.items()):
+            if fid not in wanted: self._prefetch_at.pop(fid, None); continue
+            if at <= now and not self.cached(fid):
+                self._prefetch(fid)
+            if not self.cached(fid): nxt.append(self._prefetch_at.get(fid, now + 60))
+        self._evict(wanted)
+        return (min(nxt) - now) if nxt else 300
+
+    def _prefetch(self, fid: str, critical: bool = False):
+        """Baixa do GridFS e converte para o cache. Falhas remarcam com backoff."""
+        d = _schedule_dir()
+        try:
+            data = DBI.fs.get(ObjectId(fid)).read()
+            bmp, jpg = os.path.join(d, f"{fid}.bmp"), os.path.join(d, f"{fid}.jpg")
+            WinWP.convert(data, bmp + ".tmp", jpg + ".tmp")
+            os.replace(jpg + ".tmp", jpg); os.replace(bmp + ".tmp", bmp)
+            self._failures.pop(fid, None)
+            logger.info("Agenda: %s pré-carregado%s", fid, " na hora da troca" if critical else "",
+                        extra={"route": "/agendamento", "file_id": fid, "outcome": "prefetch"})
+        except Exception as e:
+            n = self._failures[fid] = self._failures.get(fid, 0) + 1
+            self._prefetch_at[fid] = time.time() + min(3600, 30 * 2 ** n) * random.uniform(0.5, 1.0)
+            logger.warning("Agenda: falha ao pré-carregar %s: %s", fid, e, extra={"rate_key": "agenda_prefetch"})
+
+    def _activate(self, item: Dict[str, Any], key: str):
+        fid, estilo = item["file_id"], item.get("estilo") or "preencher"
+        if not self.cached(fid):
+            self._prefetch(fid, critical=True)  # pré-busca perdida (agente desligado, Mongo fora)
+        prepared = self.cached(fid)
+        if not prepared: return  # tenta de novo no próximo ciclo
+        res = APPLY_QUEUE.submit(prepared=prepared, estilo=estilo, file_id=fid).result()
+        with self._lock:
+            self.plan["aplicado"] = key
+            self._save()
+        if res.get("status") == "substituido":
+            logger.info("Agenda: troca de %s substituída por uma alteração manual", fid)
+
+    def _evict(self, wanted: set):
+        keep = wanted | {WinWP.last_file_id}
+        try: names = os.listdir(_schedule_dir())
+        except Exception: return
+        for name in names:
+            fid, ext = os.path.splitext(name)
+            if ext in (".bmp", ".jpg") and fid not in keep:
+                try: os.remove(os.path.join(_schedule_dir(), name))
+                except Exception as e: logger.warning("Agenda: falha ao remover %s: %s", name, e)
+
+    def view(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            cur = self.current(now)
+            upcoming = self._occurrences(now + 0.001, now + S.SCHEDULE_PREFETCH_H * 3600)
+            plan = dict(self.plan)
+        iso = lambda t: datetime.datetime.fromtimestamp(t, datetime.timezone.utc).isoformat()
+        return {
+            "itens": [{**i, "inicio": iso(i["inicio"]), "em_cache": bool(self.cached(i["file_id"]))} for i in plan["itens"]],
+            "ciclo_h": plan.get("ciclo_h"),
+            "vigente": {"file_id": cur[1]["file_id"], "desde": iso(cur[0])} if cur else None,
+            "proximas": [{"file_id": i["file_id"], "inicio": iso(w), "em_cache": bool(self.cached(i["file_id"])),
+                          "prefetch_em": iso(self._prefetch_at[i["file_id"]]) if i["file_id"] in self._prefetch_at else None}
+                         for w, i in upcoming],
+        }
+
+SCHEDULE = WallpaperSchedule()
+
+def _parse_when(v) -> float:
+    """ISO 8601 (sem fuso = horário local da máquina) ou epoch em segundos."""
+    if isinstance(v, (int, float)): return float(v)
+    return datetime.datetime.fromisoformat(str(v).replace("Z", "+00:00")).timestamp()
+
+@app.put("/agendamento")
+async def schedule_set(request: Request, x_agent_key: Optional[str] = None):
+    """Substitui a playlist.
+    Body JSON: { "itens": [{"file_id": "...", "inicio": "2025-01-06T08:00:00", "estilo": "preencher"}], "ciclo_h": 24 }
+    `ciclo_h` (opcional) repete a sequência a partir do primeiro item; todos devem caber no ciclo.
+    """
+    require_key(x_agent_key)
+    try: data = await request.json()
+    except Exception: raise HTTPException(status_code=400, detail="Body JSON inválido")
+    raw = data.get("itens")
+    if not isinstance(raw, list):
+        raise HTTPException(status_code=400, detail="Campo 'itens' deve ser uma lista")
+    itens = []
+    for i, it in enumerate(raw):
+        try:
+            fid, when = str(it["file_id"]), _parse_when(it["inicio"])
+        except Exception:
+            raise HTTPException(status_code=400, detail=f"Item {i}: 'file_id' e 'inicio' (ISO 8601) são obrigatórios")
+        if not ObjectId.is_valid(fid):
+            raise HTTPException(status_code=400, detail=f"Item {i}: file_id inválido")
+        estilo = it.get("estilo") or "preencher"
+        if estilo not in ESTILOS:
+            raise HTTPException(status_code=400, detail=f"Item {i}: estilo inválido. Use: " + ", ".join(ESTILOS))
+        itens.append({"file_id": fid, "inicio": when, "estilo": estilo})
+    ciclo_h = data.get("ciclo_h")
+    if ciclo_h is not None:
+        try: ciclo_h = float(ciclo_h)
+        except Exception: raise HTTPException(status_code=400, detail="'ciclo_h' deve ser numérico")
+        if ciclo_h <= 0 or not itens:
+            raise HTTPException(status_code=400, detail="'ciclo_h' exige itens e deve ser positivo")
+        first = min(i["inicio"] for i in itens)
+        if any(i["inicio"] - first >= ciclo_h * 3600 for i in itens):
+            raise HTTPException(status_code=400, detail="Todos os itens devem caber dentro de 'ciclo_h'")
+    await run_in_threadpool(SCHEDULE.set, itens, ciclo_h)
+    SCHEDULE.start()
+    return await run_in_threadpool(SCHEDULE.view)
+
+@app.get("/agendamento")
+def schedule_get():
+    return SCHEDULE.view()
+
+@app.delete("/agendamento")
+def schedule_clear(x_agent_key: Optional[str] = None):
+    require_key(x_agent_key)
+    SCHEDULE.clear()
+    return {"ok": True}
+
+# ============== RELATÓRIO DE ARMAZENAMENTO ==============
+
+AGE_BUCKETS = [(1, "0-1d"), (7, "1-7d"), (30, "7-30d"), (90, "30-90d")]  # acima do último: "90d+"
+
+class StorageReport:
+    """Uso do bucket GridFS por idade e estado de uso, calculado no Mongo com uma agregação
+    sobre `.files` (os `.chunks` nunca são varridos; deles só sai a contagem estimada).
+    O resultado fica em cache por STORAGE_REPORT_TTL_S e a limpeza/canonicalização o invalidam.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cached: Optional[Dict[str, Any]] = None
+        self._at = 0.0
+
+    def invalidate(self):
+        with self._lock: self._cached = None
+
+    def get(self, refresh: bool = False) -> Dict[str, Any]:
+        with self._lock:
+            if not refresh and self._cached and time.time() - self._at < S.STORAGE_REPORT_TTL_S:
+                return {**self._cached, "cached": True, "age_s": round(time.time() - self._at, 1)}
+        rep = FLIGHT.do("storage_report", self._compute)
+        with self._lock: self._cached, self._at = rep, time.time()
+        return {**rep, "cached": False, "age_s": 0.0}
+
+    def _compute(self) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        db = DBI.client[S.DB_NAME]
+        files, chunks = db[f"{S.WALLPAPER_COLLECTION}.files"], db[f"{S.WALLPAPER_COLLECTION}.chunks"]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # datas ingênuas em UTC: é como o pymongo as lê de volta (tz_aware=False) e compara igual no servidor
+        ref = now.replace(tzinfo=None)
+        cutoff = ref - datetime.timedelta(days=S.DAYS_TO_KEEP)
+        current = _current_wallpaper_mongo_id()
+        last_used = {"$ifNull": ["$metadata.lastUsedAt", None]}
+        never_used = {"$eq": [last_used, None]}
+        role = {"$ifNull": ["$metadata.role", ""]}
+        is_original = {"$eq": [role, "original"]}
+        pipeline = [
+            {"$project": {
+                "bytes": {"$ifNull": ["$metadata.bytes", "$length"]},
+                "chunks": {"$ceil": {"$divide": ["$length", {"$ifNull": ["$chunkSize", 261120]}]}},
+                "idade": {"$switch": {"branches": [
+                    {"case": {"$gte": ["$uploadDate", ref - datetime.timedelta(days=d)]}, "then": label}
+                    for d, label in AGE_BUCKETS], "default": f"{AGE_BUCKETS[-1][0]}d+"}},
+                "uso": {"$switch": {"branches": [
+                    {"case": is_original, "then": "original"},
+                    {"case": never_used, "then": "nunca_usado"},
+                    {"case": {"$gte": [last_used, cutoff]}, "then": "recente"},
+                ], "default": "parado"}},
+            }},
+            {"$group": {
+                "_id": {"idade": "$idade", "uso": "$uso"},
+                "files": {"$sum": 1}, "bytes": {"$sum": "$bytes"}, "chunks": {"$sum": "$chunks"},
+            }},
+        ]
+        rows = list(files.aggregate(pipeline, allowDiskUse=True))
+        # o que a limpeza removeria: o mesmo filtro de clean_old_wallpapers (o original guardado sai junto)
+        freed = list(files.aggregate([
+            {"$match": _cleanup_query(now - datetime.timedelta(days=S.DAYS_TO_KEEP), current)},
+            {"$group": {"_id": None, "files": {"$sum": 1}, "bytes": {"$sum": {"$add": [
+                {"$ifNull": ["$metadata.bytes", "$length"]},
+                {"$cond": [{"$ifNull": ["$metadata.originalId", False]},
+                           {"$ifNull": ["$metadata.canonical.originalBytes", 0]}, 0]}]}}}},
+        ])) or [{"files": 0, "bytes": 0}]
+
+        def _acc(into: Dict[str, Dict[str, int]], key: str, r: Dict[str, Any]):
+            a = into.setdefault(key, {"files": 0, "bytes": 0})
+            a["files"] += r["files"]; a["bytes"] += int(r["bytes"])
+        by_age: Dict[str, Dict[str, int]] = {}
+        by_usage: Dict[str, Dict[str, int]] = {}
+        for r in rows:
+            _acc(by_age, r["_id"]["idade"], r); _acc(by_usage, r["_id"]["uso"], r)
+        order = [label for _, label in AGE_BUCKETS] + [f"{AGE_BUCKETS[-1][0]}d+"]
+
+        top = []
+        for d in files.find({"metadata.useCount": {"$gt": 0}},
+                            {"filename": 1, "length": 1, "metadata.useCount": 1, "metadata.lastUsedAt": 1}
+                            ).sort("metadata.useCount", -1).limit(10):
+            m = d.get("metadata") or {}
+            last = m.get("lastUsedAt")
+            top.append({"file_id": str(d["_id"]), "filename": d.get("filename"), "bytes": d.get("length"),
+                        "usos": m.get("useCount"), "ultimo_uso": last.isoformat() if last else None,
+                        "atual": str(d["_id"]) == str(current or "")})
+
+        try: chunk_docs = chunks.estimated_document_count()
+        except Exception: chunk_docs = None
+        return {
+            "generated_at": now.isoformat(), "ttl_s": S.STORAGE_REPORT_TTL_S, "days_to_keep": S.DAYS_TO_KEEP,
+            "bucket": S.WALLPAPER_COLLECTION,
+            "total": {"files": sum(r["files"] for r in rows), "bytes": sum(int(r["bytes"]) for r in rows),
+                      "chunks": int(sum(r["chunks"] for r in rows)), "chunk_docs": chunk_docs},
+            "reclaimable": {"files": freed[0]["files"], "bytes": int(freed[0]["bytes"])},
+            "by_age": {k: by_age[k] for k in order if k in by_age},
+            "by_usage": by_usage,
+            "matrix": sorted(({"idade": r["_id"]["idade"], "uso": r["_id"]["uso"], "files": r["files"], "bytes": int(r["bytes"])}
+                              for r in rows), key=lambda x: (order.index(x["idade"]) if x["idade"] in order else 99, x["uso"])),
+            "top_used": top,
+            "duration_ms": round((time.perf_counter() - t0) * 1000, 1),
+        }
+
+STORAGE_REPORT = StorageReport()
+
+@app.get("/storage/report")
+def storage_report(request: Request, refresh: bool = False, fields: Optional[str] = None):
+    """Espaço usado no bucket por idade/uso, quanto a limpeza (DAYS_TO_KEEP) liberaria e
+    as imagens mais aplicadas. `refresh=true` ignora o cache."""
+    try:
+        return negotiate(request, STORAGE_REPORT.get(refresh), fields)
+    except Exception as e:
+        logger.exception("Erro em /storage/report")
+        raise HTTPException(status_code=500, detail=f"Erro ao gerar relatório: {e}")
+
+@app.post("/storage/canonicalize")
+def storage_canonicalize_start(batch: int = 50, limit: Optional[int] = None, manter_original: bool = False,
+                               x_agent_key: Optional[str] = None):
+    """Inicia o re-encode em lotes do acervo existente (ver CANON_*). Acompanhe via GET."""
+    require_key(x_agent_key)
+    if not CANON_JOB.start(max(1, batch), limit, manter_original):
+        raise HTTPException(status_code=409, detail="Canonicalização já em andamento")
+    return CANON_JOB.status
+
+@app.get("/storage/canonicalize")
+def storage_canonicalize_status():
+    return CANON_JOB.status
+
+@app.post("/storage/phash")
+def storage_phash_start(limit: Optional[int] = None, x_agent_key: Optional[str] = None):
+    """Calcula o phash dos arquivos gravados antes do índice de similares (basta uma vez para o
+    acervo; pode rodar em vários agentes, cada arquivo é processado por um só). Acompanhe via GET."""
+    require_key(x_agent_key)
+    if not PHASH_JOB.start(limit):
+        raise HTTPException(status_code=409, detail="Cálculo de phash já em andamento")
+    return PHASH_JOB.status
+
+@app.get("/storage/phash")
+def storage_phash_status():
+    return PHASH_JOB.status
+
 @app.post("/forcar_refresh")
 def forcar_refresh():
-    appdata = os.getenv('APPDATA') or os.path.expanduser('~')
-    bmp = WinWP.last_bmp_path or os.path.join(appdata,'WallpaperAgent','wallpaper.bmp')
+    bmp = WinWP.last_bmp_path or _default_bmp_path()
     if not os.path.exists(bmp): raise HTTPException(status_code=404, detail=f"BMP não encontrado em {bmp}")
     SPI=0x0014; SPIF=0x01|0x02
-    ctypes.windll.user32.SystemParametersInfoW(SPI,0,None,SPIF)
-    ok = ctypes.windll.user32.SystemParametersInfoW(SPI,0,bmp,SPIF)
-    if not ok: raise HTTPException(status_code=500, detail=f"Falha SPI (erro {ctypes.get_last_error()})")
+    PLATFORM.spi(SPI,0,None,SPIF)
+    ok = PLATFORM.spi(SPI,0,bmp,SPIF)
+    if not ok: raise HTTPException(status_code=500, detail=f"Falha SPI (erro {PLATFORM.last_error()})")
     return {"status":"sucesso","mensagem":"Refresh forçado","bmp_path":bmp}
 
 # ============== WEBSITE BLOCKER (hosts) ==============
 
 # Caminho padrão do hosts no Windows
 HOSTS_PATH = r"C:\\Windows\\System32\\drivers\\etc\\hosts"
-IP_REDIRECT = "127.0.0.1"
+IP_REDIRECT = hosts_engine.IP_REDIRECT
 
 def _normalize_websites(websites: _List[str]) -> _List[str]:
-    out = []
-    for w in websites or []:
-        w = (w or "").strip()
-        if not w:
-            continue
-        # remove esquema e barras
-        w = w.replace("http://", "").replace("https://", "").strip("/ ")
-        # evita linhas com espaços múltiplos
-        w = w.split()[0]
-        if w and w not in out:
-            out.append(w)
-    return out
-
-def _ensure_writable(p: str):
-    try:
-        os.chmod(p, 0o666)
-    except Exception:
-        pass
+    return hosts_engine.normalize(websites)
 
 def _block_in_hosts(websites: _List[str]) -> int:
-    sites = _normalize_websites(websites)
-    if not sites:
-        return 0
-    _ensure_writable(HOSTS_PATH)
-    # lê conteúdo existente
-    try:
-        with open(HOSTS_PATH, "r", encoding="utf-8", errors="ignore") as f:
-            content = f.read()
-    except FileNotFoundError:
-        content = ""
-    added = 0
-    with open(HOSTS_PATH, "a", encoding="utf-8", errors="ignore") as f:
-        for s in sites:
-            entry = f"{IP_REDIRECT} {s}"
-            if entry not in content:
-                f.write(entry + "\n")
-                added += 1
-    return added
+    return hosts_engine.apply(HOSTS_PATH, block=websites, redirect=IP_REDIRECT)[0]
 
 def _unblock_in_hosts(websites: _List[str]) -> int:
-    sites = _normalize_websites(websites)
-    if not sites:
-        return 0
-    _ensure_writable(HOSTS_PATH)
-    try:
-        with open(HOSTS_PATH, "r", encoding="utf-8", errors="ignore") as f:
-            lines = f.readlines()
-    except FileNotFoundError:
-        return 0
-    kept = []
-    removed = 0
-    for line in lines:
-        if any((s in line) for s in sites):
-            removed += 1
-            continue
-        kept.append(line)
-    with open(HOSTS_PATH, "w", encoding="utf-8", errors="ignore") as f:
-        f.writelines(kept)
-    return removed
+    """Remove os sites e seus subdomínios (antes: qualquer linha que contivesse o texto)."""
+    return hosts_engine.apply(HOSTS_PATH, unblock=websites, redirect=IP_REDIRECT)[1]
 
 def _list_blocked_hosts() -> _List[str]:
-    out: _List[str] = []
-    try:
-        with open(HOSTS_PATH, "r", encoding="utf-8", errors="ignore") as f:
-            for line in f:
-                ln = line.strip()
-                if not ln or ln.startswith("#"): 
-                    continue
-                parts = ln.split()
-                if len(parts) >= 2 and parts[0] == IP_REDIRECT:
-                    host = parts[1].strip()
-                    if host and host not in out:
-                        out.append(host)
-    except FileNotFoundError:
-        pass
-    return out
+    return hosts_engine.list_blocked(HOSTS_PATH, IP_REDIRECT)
 
 @app.post("/block_sites")
 async def block_sites_api(request: Request, x_agent_key: Optional[str] = None):
@@ -743,7 +2436,7 @@ async def block_sites_api(request: Request, x_agent_key: Optional[str] = None):
         websites = data.get("websites") or []
         if not isinstance(websites, list):
             raise HTTPException(status_code=400, detail="Campo 'websites' deve ser uma lista de strings")
-        n = _block_in_hosts([str(x) for x in websites])
+        n = await run_in_threadpool(_block_in_hosts, [str(x) for x in websites])
         return {"ok": True, "message": f"{n} entradas adicionadas ao hosts", "count": n}
     except HTTPException:
         raise
@@ -764,7 +2457,7 @@ async def unblock_sites_api(request: Request, x_agent_key: Optional[str] = None)
         websites = data.get("websites") or []
         if not isinstance(websites, list):
             raise HTTPException(status_code=400, detail="Campo 'websites' deve ser uma lista de strings")
-        n = _unblock_in_hosts([str(x) for x in websites])
+        n = await run_in_threadpool(_unblock_in_hosts, [str(x) for x in websites])
         return {"ok": True, "message": f"{n} entradas removidas do hosts", "count": n}
     except HTTPException:
         raise
@@ -775,12 +2468,13 @@ async def unblock_sites_api(request: Request, x_agent_key: Optional[str] = None)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/blocked_sites")
-def blocked_sites_api(x_agent_key: Optional[str] = None):
-    """Lista os domínios atualmente bloqueados no arquivo hosts (127.0.0.1 <host>)."""
+def blocked_sites_api(request: Request, fields: Optional[str] = None, x_agent_key: Optional[str] = None):
+    """Lista os domínios atualmente bloqueados no arquivo hosts (127.0.0.1 <host>).
+    `?fields=count` evita trafegar a lista; aceita MessagePack como /obter_status."""
     require_key(x_agent_key)
     try:
         items = _list_blocked_hosts()
-        return {"ok": True, "items": items, "count": len(items)}
+        return negotiate(request, {"ok": True, "items": items, "count": len(items)}, fields)
     except HTTPException:
         raise
     except Exception as e:
@@ -791,12 +2485,26 @@ def blocked_sites_api(x_agent_key: Optional[str] = None):
 
 def _current_wallpaper_mongo_id() -> Optional[ObjectId]:
     try:
-        import winreg
+        winreg = PLATFORM.winreg()
         k = winreg.OpenKey(winreg.HKEY_CURRENT_USER, "Control Panel\\Desktop", 0, winreg.KEY_READ)
         mid = winreg.QueryValueEx(k, "WallpaperMongoID")[0]; k.Close()
         return ObjectId(mid) if mid and ObjectId.is_valid(mid) else None
     except: return None
 
+def _cleanup_query(cutoff: datetime.datetime, current_id) -> Dict[str, Any]:
+    """Filtro da limpeza, também usado no `reclaimable` de /storage/report."""
+    query = {
+        "uploadDate": {"$lt": cutoff},
+        "metadata.role": {"$ne": "original"},  # originais saem junto com a versão canônica
+        "$or": [
+            {"metadata.lastUsedAt": {"$exists": False}},
+            {"metadata.lastUsedAt": {"$lt": cutoff}}
+        ]
+    }
+    if current_id:
+        query["_id"] = {"$ne": current_id}
+    return query
+
 def clean_old_wallpapers():
     try:
         db = DBI.client[S.DB_NAME]
@@ -805,28 +2513,22 @@ def clean_old_wallpapers():
 
         current_id = _current_wallpaper_mongo_id()
 
-        query = {
-            "uploadDate": {"$lt": cutoff},
-            "$or": [
-                {"metadata.lastUsedAt": {"$exists": False}},
-                {"metadata.lastUsedAt": {"$lt": cutoff}}
-            ]
-        }
-        if current_id:
-            query["_id"] = {"$ne": current_id}
-
-        cur = files.find(query, {"_id": 1})
+        cur = files.find(_cleanup_query(cutoff, current_id), {"_id": 1, "metadata.originalId": 1})
         deleted = 0
         for f in cur:
             try:
                 DBI.fs.delete(f["_id"]); deleted += 1
+                PHASH_INDEX.discard(str(f["_id"]))
+                orig = (f.get("metadata") or {}).get("originalId")
+                if orig: DBI.fs.delete(orig)
             except Exception as e:
-                logger.warning(f"Erro ao remover {f['_id']}: {e}")
+                logger.warning("Erro ao remover %s: %s", f['_id'], e)
 
         if deleted:
-            logger.info(f"Limpeza: {deleted} arquivos removidos")
+            logger.info("Limpeza: %s arquivos removidos", deleted)
+            STORAGE_REPORT.invalidate()
     except Exception as e:
-        logger.warning(f"Erro limpeza: {e}")
+        logger.warning("Erro limpeza: %s", e)
 
 def _start_background_tasks():
     import threading
@@ -836,9 +2538,35 @@ def _start_background_tasks():
         while True:
             try: clean_old_wallpapers()
             except: pass
+            try: UPLOADS.sweep()
+            except: pass
             time.sleep(24*3600)
     threading.Thread(target=_loop, daemon=True).start()
 
+    def _metrics():
+        while True:
+            try: METRICS.sample()
+            except Exception as e: logger.warning("Métricas: %s", e, extra={"rate_key": "metrics"})
+            time.sleep(S.METRICS_INTERVAL)
+    threading.Thread(target=_metrics, name="metrics", daemon=True).start()
+
+    def _phash_index():
+        # uploads de outros agentes só chegam ao índice deste agente pela releitura periódica
+        PHASH_INDEX.build()
+        while True:
+            time.sleep(S.PHASH_REFRESH_H * 3600)
+            try:
+                added, removed = PHASH_INDEX.refresh()
+                logger.info("Índice de similares atualizado: +%s -%s", added, removed)
+            except Exception as e: logger.warning("Índice de similares: %s", e, extra={"rate_key": "phash_refresh"})
+    threading.Thread(target=_phash_index, name="phash-index", daemon=True).start()
+
+    def _canon_recover():
+        try: CANON_JOB.recover()
+        except Exception as e: logger.warning("Canonicalização (recuperação): %s", e, extra={"rate_key": "canonicalize"})
+    threading.Thread(target=_canon_recover, name="canonicalize-recover", daemon=True).start()
+    SCHEDULE.start()
+
 def _register_with_backend():
     import threading, requests
     def _runner():
@@ -858,9 +2586,9 @@ def _register_with_backend():
                     "motherboard": sysinfo.get("motherboard"),
                 }
                 r = requests.post(f"{S.URL_BACKEND}/registrar", json=dados, timeout=10)
-                logger.info(f"Registrado no backend: {r.status_code}")
+                logger.info("Registrado no backend: %s", r.status_code)
             except Exception as e:
-                logger.error(f"Erro ao registrar no backend: {e}")
+                logger.error("Erro ao registrar no backend: %s", e, extra={"rate_key": "backend_register"})
             time.sleep(60)
     if S.REGISTRAR_COM_BACKEND:
         threading.Thread(target=_runner, daemon=True).start()
@@ -869,23 +2597,24 @@ def _register_with_backend():
 def startup():
     logger.info("="*60)
     logger.info("Iniciando o agente…")
-    logger.info(f"ID: {S.ID_AGENTE} | Backend: {S.URL_BACKEND} | Registrar? {S.REGISTRAR_COM_BACKEND}")
-    logger.info(f"Listen: http://{S.HOST}:{S.PORT}")
+    logger.info("ID: %s | Backend: %s | Registrar? %s", S.ID_AGENTE, S.URL_BACKEND, S.REGISTRAR_COM_BACKEND)
+    logger.info("Listen: http://%s:%s", S.HOST, S.PORT)
     # gravar AgentUrl no Registro
     try:
         _write_registry_value("AgentUrl", f"http://{local_ip()}:{S.PORT}")
     except: pass
     # autostart (opcional)
     try:
-        import winreg
+        winreg = PLATFORM.winreg()
         run_path = r"Software\Microsoft\Windows\CurrentVersion\Run"
         cmd = f'"{sys.executable}" "{os.path.abspath(__file__)}"'
         k = winreg.CreateKey(winreg.HKEY_CURRENT_USER, run_path)
         winreg.SetValueEx(k, "WallpaperAgent", 0, winreg.REG_SZ, cmd); k.Close()
         logger.info("Auto-start configurado em HKCU\\...\\Run")
     except Exception as e:
-        logger.warning(f"Auto-start: {e}")
+        logger.warning("Auto-start: %s", e)
 
+    UPLOADS.sweep()
     _start_background_tasks()
     _register_with_backend()
 
@@ -898,8 +2627,8 @@ if __name__ == "__main__":
         logger.error("="*50)
         logger.error("ERRO CRÍTICO")
         logger.error("="*50)
-        logger.error(f"Tipo do erro: {type(e).__name__}")
-        logger.error(f"Mensagem: {str(e)}")
+        logger.error("Tipo do erro: %s", type(e).__name__)
+        logger.error("Mensagem: %s", str(e))
         logger.error("Traceback completo:")
         logger.error(traceback.format_exc())
         logger.error("="*50)
@@ -0,0 +1,25 @@
+"""Fixtures dos testes do agente (server.py), rodando fora do Windows.
+
+O server.py é importado como no benchmark: APPDATA/PROGRAMDATA temporários,
+mongomock no lugar do Mongo e bench/fake_platform.py no lugar do Windows.
+Dependências: requirements.txt + bench/requirements.txt + pytest.
+"""
+import os, sys, types
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AGENT_DIR = os.path.dirname(HERE)
+sys.path.insert(0, AGENT_DIR)
+sys.path.insert(0, os.path.join(AGENT_DIR, "bench"))
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    import run_bench
+    cwd = os.getcwd()
+    args = types.SimpleNamespace(db_name="wallpaper_tests", mongo_uri=None, cmd_latency=0, spi_latency=0)
+    try:
+        yield run_bench.load_agent(args, str(tmp_path_factory.mktemp("agent")))
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,27 @@
+import threading
+
+
+def _idle_queue(server):
+    """ApplyQueue sem worker: os pedidos ficam pendentes até o teste olhar."""
+    q = server.ApplyQueue()
+    q._thread = threading.current_thread()
+    return q
+
+
+def test_newer_submit_supersedes_pending(server):
+    q = _idle_queue(server)
+    first = q.submit(estilo="preencher")
+    second = q.submit(estilo="ajustar")
+    assert first.result(0)["status"] == "substituido"
+    assert first.result(0)["estilo"] == "preencher"
+    assert not second.done()
+
+
+def test_submit_after_cancelled_pending_is_enqueued(server):
+    q = _idle_queue(server)
+    q.submit(estilo="preencher")
+    cancelled = q.submit(estilo="ajustar")
+    assert cancelled.cancel()  # handler cancelado: asyncio.wrap_future cancela o Future
+    latest = q.submit(estilo="centralizar")
+    assert cancelled.cancelled()
+    assert q._pending == ({"estilo": "centralizar"}, latest)
@@ -0,0 +1,42 @@
+import datetime, hashlib
+
+import pytest
+from bson import ObjectId
+
+import run_bench
+
+
+class Killed(BaseException):
+    """Simula o agente morto no meio da troca (não é capturado como Exception)."""
+
+
+@pytest.fixture
+def files(server):
+    return server.DBI.client[server.S.DB_NAME][f"{server.S.WALLPAPER_COLLECTION}.files"]
+
+
+def test_interrupted_swap_is_restored_from_backup(server, files, monkeypatch):
+    data = run_bench._image(7, (1600, 900), "PNG")
+    oid = ObjectId(server.save_img_dedup(data, "sala.png", "image/png"))
+    uploaded = datetime.datetime(2026, 1, 1)
+    files.update_one({"_id": oid}, {"$set": {"uploadDate": uploaded}})
+
+    def killed(*a, **k): raise Killed()
+    monkeypatch.setattr(server.CanonicalizeJob, "_put_at", killed)
+    job = server.CanonicalizeJob()
+    job.status = {"reencoded": 0, "bytes_before": 0, "bytes_after": 0, "bytes_reclaimed": 0}
+    with pytest.raises(Killed):
+        job._one(files, oid, keep_original=False)
+    monkeypatch.undo()
+
+    assert files.find_one({"_id": oid}) is None
+    assert files.count_documents({"metadata.canonBackupOf": oid}) == 1
+
+    assert job.recover() == 1
+    doc = files.find_one({"_id": oid})
+    sha = hashlib.sha256(data).hexdigest()
+    assert doc["filename"] == "sala.png" and doc["uploadDate"] == uploaded
+    assert doc["metadata"]["sha256"] == sha and "role" not in doc["metadata"]
+    assert server.DBI.fs.get(oid).read() == data
+    assert server.find_img_by_sha(sha) == str(oid)
+    assert files.count_documents({"metadata.canonBackupOf": {"$exists": True}}) == 0
@@ -0,0 +1,51 @@
+import os, stat
+
+import hosts_engine
+
+
+def _read_only_denied(path):
+    return os.path.exists(path) and not os.stat(path).st_mode & stat.S_IWRITE
+
+
+def _as_windows(monkeypatch):
+    """os.replace e open(..., "w") como no Windows: alvo somente leitura -> PermissionError
+    (aqui, como root, o Linux gravaria mesmo assim)."""
+    real_replace = os.replace
+    def replace(src, dst):
+        if _read_only_denied(dst): raise PermissionError(13, "Acesso negado", dst)
+        return real_replace(src, dst)
+    def fake_open(file, mode="r", *args, **kwargs):
+        if "w" in mode and _read_only_denied(file): raise PermissionError(13, "Acesso negado", file)
+        return open(file, mode, *args, **kwargs)
+    monkeypatch.setattr(hosts_engine.os, "replace", replace)
+    monkeypatch.setattr(hosts_engine, "open", fake_open, raising=False)
+
+
+def test_commit_on_read_only_hosts_keeps_it_read_only(tmp_path, monkeypatch):
+    hosts = tmp_path / "hosts"
+    hosts.write_text("127.0.0.1 localhost\n", encoding="utf-8")
+    os.chmod(hosts, stat.S_IREAD)
+    _as_windows(monkeypatch)
+
+    assert hosts_engine.apply(str(hosts), block=["exemplo.com"]) == (1, 0)
+
+    assert hosts_engine.list_blocked(str(hosts)) == ["localhost", "exemplo.com"]
+    assert stat.S_IMODE(os.stat(hosts).st_mode) == stat.S_IREAD
+    assert [p.name for p in tmp_path.iterdir()] == ["hosts"]
+
+
+def test_commit_restores_mode_when_write_fails(tmp_path, monkeypatch):
+    hosts = tmp_path / "hosts"
+    hosts.write_text("127.0.0.1 bloqueado.com\n", encoding="utf-8")
+    os.chmod(hosts, stat.S_IREAD)
+
+    def fail(src, dst): raise OSError(5, "disco")
+    monkeypatch.setattr(hosts_engine.os, "replace", fail)
+
+    try: hosts_engine.apply(str(hosts), unblock=["bloqueado.com"])
+    except OSError: pass
+    else: raise AssertionError("esperava OSError")
+
+    assert stat.S_IMODE(os.stat(hosts).st_mode) == stat.S_IREAD
+    assert hosts_engine.list_blocked(str(hosts)) == ["bloqueado.com"]
+    assert [p.name for p in tmp_path.iterdir()] == ["hosts"]
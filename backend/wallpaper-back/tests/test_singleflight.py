@@ -0,0 +1,71 @@
+import threading, time
+
+N = 16
+
+
+def _run_concurrently(flight, key, fn):
+    """N threads chamam flight.do(key, fn) juntas; devolve (resultados, exceções) por thread."""
+    start = threading.Barrier(N)
+    results, errors = [None] * N, [None] * N
+
+    def worker(i):
+        start.wait()
+        try: results[i] = flight.do(key, fn)
+        except Exception as e: errors[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(N)]
+    for t in threads: t.start()
+    return threads, results, errors
+
+
+def _gated(release: threading.Event, calls: list, outcome):
+    """fn falsa que só termina quando o teste libera; conta quantas vezes rodou."""
+    def fn():
+        calls.append(threading.get_ident())
+        assert release.wait(5), "fn nunca foi liberada"
+        if isinstance(outcome, BaseException): raise outcome
+        return outcome
+    return fn
+
+
+def _release_when_all_waiting(flight, key, release, calls):
+    # o líder já está dentro de fn; dá tempo para os demais chegarem em call.done.wait()
+    deadline = time.monotonic() + 5
+    while not calls and time.monotonic() < deadline: time.sleep(0.001)
+    time.sleep(0.2)
+    assert key in flight._calls
+    release.set()
+
+
+def test_parallel_calls_share_one_execution(server):
+    flight, key = server.SingleFlight(), "status:http://mongo"
+    release, calls, payload = threading.Event(), [], {"ok": True}
+    threads, results, errors = _run_concurrently(flight, key, _gated(release, calls, payload))
+    _release_when_all_waiting(flight, key, release, calls)
+    for t in threads: t.join(5)
+
+    assert len(calls) == 1
+    assert errors == [None] * N
+    assert all(r is payload for r in results)
+    assert flight._calls == {}
+
+
+def test_exception_reaches_every_waiter(server):
+    flight, key = server.SingleFlight(), "file:abc"
+    release, calls, boom = threading.Event(), [], ValueError("mongo caiu")
+    threads, results, errors = _run_concurrently(flight, key, _gated(release, calls, boom))
+    _release_when_all_waiting(flight, key, release, calls)
+    for t in threads: t.join(5)
+
+    assert len(calls) == 1
+    assert all(e is boom for e in errors)
+    assert results == [None] * N
+    assert flight._calls == {}
+
+
+def test_nothing_is_cached_after_the_call(server):
+    flight, calls = server.SingleFlight(), []
+    fn = lambda: calls.append(1) or len(calls)
+    assert flight.do("storage_report", fn) == 1
+    assert flight.do("storage_report", fn) == 2
+    assert flight.do("outra", fn) == 3
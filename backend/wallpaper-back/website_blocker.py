@@ -1,8 +1,12 @@
 import os
 import sys
 import ctypes
+import queue
+import threading
 from tkinter import *
-import stat
+from tkinter import ttk, filedialog
+
+import hosts_engine
 
 # ---------- Função para garantir privilégios de administrador ----------
 def ensure_admin():
@@ -31,59 +35,141 @@ ensure_admin()
 
 # ---------- Caminho do hosts ----------
 HOSTS_PATH = r"C:\Windows\System32\drivers\etc\hosts"
-IP_ADDRESS = "127.0.0.1"
+IP_ADDRESS = hosts_engine.IP_REDIRECT
 
 # ---------- Janela Tkinter ----------
 window = Tk()
 window.title("Website Blocker")
-window.geometry("650x400")
+window.geometry("650x420")
 window.resizable(False, False)
 
 Label(window, text="Website Blocker", font=("Arial", 16, "bold")).pack(pady=10)
 Label(window, text="Digite os sites (um por linha):", font=("Arial", 12)).place(x=10, y=50)
 
-site_input = Text(window, height=10, width=50, font=("Arial", 12))
+site_input = Text(window, height=8, width=50, font=("Arial", 12))
 site_input.place(x=10, y=80)
 
+progress_bar = ttk.Progressbar(window, length=450, mode="determinate", maximum=100)
+progress_bar.place(x=10, y=300)
+
 status_label = Label(window, text="", font=("Arial", 12))
-status_label.place(x=10, y=300)
+status_label.place(x=10, y=330)
 
-# ---------- Funções de bloquear e desbloquear ----------
-def block_sites():
-    websites = [w.strip() for w in site_input.get(1.0, END).splitlines() if w.strip()]
-    try:
-        os.chmod(HOSTS_PATH, stat.S_IWRITE)
-    except:
-        pass
+import_label = Label(window, text="Nenhum arquivo importado", font=("Arial", 10), fg="gray30")
+import_label.place(x=10, y=370)
 
-    with open(HOSTS_PATH, "r+", encoding="utf-8") as file:
-        content = file.read()
-        for web in websites:
-            entry = f"{IP_ADDRESS} {web}"
-            if entry in content:
-                continue
-            file.write(entry + "\n")
-    status_label.config(text="Sites bloqueados com sucesso!")
+# ---------- Trabalho em segundo plano ----------
+# O hosts é processado numa thread; a interface só consome `events` (via after) e nunca trava.
+events: "queue.Queue[tuple]" = queue.Queue()
+cancel_event = threading.Event()
+imported: list = []  # domínios vindos de arquivo (não passam pela caixa de texto)
+busy = False
 
-def unblock_sites():
-    websites = [w.strip() for w in site_input.get(1.0, END).splitlines() if w.strip()]
+ETAPAS = {"lendo": "Lendo o hosts...", "bloqueando": "Bloqueando", "desbloqueando": "Desbloqueando",
+          "gravando": "Gravando o hosts...", "importando": "Importando lista", "concluido": "Concluído"}
+
+def _report(stage, done, total):
+    events.put(("progress", stage, done, total))
+
+def run_in_background(job, on_done):
+    """Executa `job()` numa thread; `on_done(resultado)` roda depois na thread da interface."""
+    global busy
+    if busy:
+        return
+    busy = True
+    cancel_event.clear()
+    _set_busy(True)
+    def _worker():
+        try:
+            events.put(("done", on_done, job(), None))
+        except hosts_engine.Cancelled:
+            events.put(("done", None, None, "Operação cancelada; o hosts não foi alterado."))
+        except PermissionError:
+            events.put(("done", None, None, "Sem permissão para editar o hosts. Execute como Administrador."))
+        except Exception as e:
+            events.put(("done", None, None, f"Erro: {e}"))
+    threading.Thread(target=_worker, daemon=True).start()
+
+def _poll_events():
+    global busy
     try:
-        os.chmod(HOSTS_PATH, stat.S_IWRITE)
-    except:
+        while True:
+            ev = events.get_nowait()
+            if ev[0] == "progress":
+                _, stage, done, total = ev
+                progress_bar["value"] = 100 * done / total if total else 0
+                label = ETAPAS.get(stage, stage)
+                status_label.config(text=f"{label} {done}/{total}" if total > 1 else label)
+            else:
+                _, on_done, result, error = ev
+                busy = False
+                _set_busy(False)
+                if error:
+                    status_label.config(text=error)
+                elif on_done:
+                    on_done(result)
+    except queue.Empty:
         pass
+    window.after(50, _poll_events)
 
-    with open(HOSTS_PATH, "r", encoding="utf-8") as file:
-        lines = file.readlines()
+def _set_busy(flag):
+    for b in (block_button, unblock_button, import_button, clear_button):
+        b.config(state=DISABLED if flag else NORMAL)
+    cancel_button.config(state=NORMAL if flag else DISABLED)
+    if flag:
+        progress_bar["value"] = 0
 
-    with open(HOSTS_PATH, "w", encoding="utf-8") as file:
-        for line in lines:
-            if not any(web in line for web in websites):
-                file.write(line)
+def _websites():
+    return [w.strip() for w in site_input.get(1.0, END).splitlines() if w.strip()] + imported
 
-    status_label.config(text="Sites desbloqueados com sucesso!")
+# ---------- Funções de bloquear e desbloquear ----------
+def block_sites():
+    websites = _websites()
+    def _done(res):
+        progress_bar["value"] = 100
+        status_label.config(text=f"Sites bloqueados com sucesso! ({res[0]} novos)")
+    run_in_background(lambda: hosts_engine.apply(HOSTS_PATH, block=websites, redirect=IP_ADDRESS,
+                                                 progress=_report, cancel=cancel_event), _done)
 
-# ---------- Botões ----------
-Button(window, text="Bloquear", font=("Arial", 12), width=10, command=block_sites, bg="royal blue1", fg="white").place(x=150, y=250)
-Button(window, text="Desbloquear", font=("Arial", 12), width=10, command=unblock_sites, bg="green", fg="white").place(x=300, y=250)
+def unblock_sites():
+    websites = _websites()
+    def _done(res):
+        progress_bar["value"] = 100
+        status_label.config(text=f"Sites desbloqueados com sucesso! ({res[1]} removidos)")
+    run_in_background(lambda: hosts_engine.apply(HOSTS_PATH, unblock=websites, redirect=IP_ADDRESS,
+                                                 progress=_report, cancel=cancel_event), _done)
+
+def import_file():
+    path = filedialog.askopenfilename(title="Importar lista de sites",
+                                      filetypes=[("Listas de texto", "*.txt *.hosts *.list"), ("Todos os arquivos", "*.*")])
+    if not path:
+        return
+    def _done(domains):
+        imported[:] = domains
+        progress_bar["value"] = 100
+        import_label.config(text=f"{len(domains)} sites importados de {os.path.basename(path)}")
+        status_label.config(text="Lista importada. Use Bloquear ou Desbloquear.")
+    run_in_background(lambda: hosts_engine.read_domain_list(path, progress=_report, cancel=cancel_event), _done)
+
+def clear_import():
+    imported.clear()
+    import_label.config(text="Nenhum arquivo importado")
 
+def cancel_job():
+    cancel_event.set()
+    status_label.config(text="Cancelando...")
+
+# ---------- Botões ----------
+block_button = Button(window, text="Bloquear", font=("Arial", 12), width=10, command=block_sites, bg="royal blue1", fg="white")
+block_button.place(x=150, y=250)
+unblock_button = Button(window, text="Desbloquear", font=("Arial", 12), width=10, command=unblock_sites, bg="green", fg="white")
+unblock_button.place(x=300, y=250)
+import_button = Button(window, text="Importar arquivo...", font=("Arial", 11), width=16, command=import_file)
+import_button.place(x=480, y=80)
+clear_button = Button(window, text="Limpar importação", font=("Arial", 11), width=16, command=clear_import)
+clear_button.place(x=480, y=120)
+cancel_button = Button(window, text="Cancelar", font=("Arial", 11), width=16, command=cancel_job, state=DISABLED)
+cancel_button.place(x=480, y=296)
+
+window.after(50, _poll_events)
 window.mainloop()
@@ -10,12 +10,18 @@ import LocationModal from '../components/LocationModal';
 import api from '../services/apiService';
 import MachineCodeModal from '../components/MachineCodeModal';
 import * as Dialog from '@radix-ui/react-dialog';
+import agentService from '../services/agentService';
+
+const RESUMABLE_MIN_BYTES = 4 * 1024 * 1024; // acima disso o envio usa upload retomável
+const STALE_MAX_MS = 30 * 1000; // stream reconectando há mais que isso: máquina passa a offline
 
 export default function WallpaperManager() {
   const [machines, setMachines] = useState([]);
   const [agentStatuses, setAgentStatuses] = useState({}); // { machineId: { loading, error, data } }
   const [uploading, setUploading] = useState({}); // { machineId: boolean }
   const fileInputsRef = useRef({}); // { machineId: inputRef }
+  const machinesRef = useRef(machines); // estado atual para callbacks de longa duração (stream/polling)
+  machinesRef.current = machines;
   const [isAddItemModalOpen, setIsAddItemModalOpen] = useState(false);
   const [isLocationModalOpen, setIsLocationModalOpen] = useState(false);
   const [locations, setLocations] = useState([]); // saved locations from LocationModal
@@ -37,8 +43,7 @@ export default function WallpaperManager() {
     try {
       const list = await machineService.getAllMachines();
       setMachines(list);
-      // Após carregar máquinas, buscar status dos agentes
-      list.forEach((m) => fetchAgentStatus(m));
+      // O status dos agentes chega pelo stream aberto no efeito abaixo
     } catch (e) {
       toast.error('Erro ao carregar máquinas');
       console.error(e);
@@ -66,22 +71,40 @@ export default function WallpaperManager() {
       if (!res.ok) throw new Error('Falha ao obter status');
       const data = await res.json();
       setAgentStatuses((prev) => ({ ...prev, [machine._id]: { loading: false, error: null, data } }));
-      // Persistir MAC aprendido do agente, se diferente do salvo
-      try {
-        const firstMac = Array.isArray(data?.macs) && data.macs.length > 0 ? data.macs[0] : null;
-        if (firstMac && machine?.mac !== firstMac) {
-          await machineService.updateMachine(machine._id, { mac: firstMac });
-          // atualizar estado local de machines
-          setMachines((prev) => prev.map(m => m._id === machine._id ? { ...m, mac: firstMac } : m));
-        }
-      } catch (persistErr) {
-        console.warn('Falha ao persistir MAC aprendido do agente:', persistErr);
-      }
+      await persistLearnedMac(machine, data);
     } catch (e) {
       setAgentStatuses((prev) => ({ ...prev, [machine._id]: { loading: false, error: e.message || 'Erro', data: null } }));
     }
   };
 
+  // Persistir MAC aprendido do agente, se diferente do salvo
+  const persistLearnedMac = async (machine, data) => {
+    try {
+      const firstMac = Array.isArray(data?.macs) && data.macs.length > 0 ? data.macs[0] : null;
+      // compara com o estado atual, não com o `machine` capturado quando o stream foi aberto
+      const current = machinesRef.current.find((x) => x._id === machine._id) || machine;
+      if (firstMac && current?.mac !== firstMac) {
+        await machineService.updateMachine(machine._id, { mac: firstMac });
+        // atualizar estado local de machines (o ref já, para um snapshot que chegue antes do render)
+        machinesRef.current = machinesRef.current.map(m => m._id === machine._id ? { ...m, mac: firstMac } : m);
+        setMachines((prev) => prev.map(m => m._id === machine._id ? { ...m, mac: firstMac } : m));
+      }
+    } catch (persistErr) {
+      console.warn('Falha ao persistir MAC aprendido do agente:', persistErr);
+    }
+  };
+
+  // Aplica um evento parcial do stream sobre o último status conhecido
+  const mergeStatus = (machineId, patch) => {
+    setAgentStatuses((prev) => {
+      const data = prev[machineId]?.data;
+      if (!data) return prev;
+      const next = { ...data, ...patch, timestamp: new Date().toISOString() };
+      if (patch.hardware) next.hardware = { ...data.hardware, ...patch.hardware };
+      return { ...prev, [machineId]: { loading: false, error: null, data: next } };
+    });
+  };
+
   const handlePickFile = (machineId) => {
     if (!fileInputsRef.current[machineId]) {
       fileInputsRef.current[machineId] = { input: null };
@@ -187,14 +210,57 @@ export default function WallpaperManager() {
     event.target.value = '';
   };
 
-  // Polling leve para manter status atualizados
+  // Status por stream (SSE): snapshot inicial + apenas mudanças.
+  // Agentes sem /obter_status/stream (versões antigas) caem no polling leve.
+  const machineKeys = machines.map((m) => `${m._id}|${m.agentUrl || ''}`).join(',');
   useEffect(() => {
     if (!machines?.length) return;
+    const sources = [];
+    const polled = new Set();
+    machines.forEach((m) => {
+      if (!m?.agentUrl || typeof EventSource === 'undefined') {
+        polled.add(m);
+        fetchAgentStatus(m);
+        return;
+      }
+      setAgentStatuses((prev) => ({ ...prev, [m._id]: { loading: true, error: null, data: prev[m._id]?.data || null } }));
+      const es = new EventSource(`${m.agentUrl}/obter_status/stream`);
+      sources.push(es);
+      es.addEventListener('snapshot', (ev) => {
+        const data = JSON.parse(ev.data);
+        setAgentStatuses((prev) => ({ ...prev, [m._id]: { loading: false, error: null, data } }));
+        persistLearnedMac(m, data);
+      });
+      ['wallpaper', 'disk', 'mongo'].forEach((name) => {
+        es.addEventListener(name, (ev) => mergeStatus(m._id, JSON.parse(ev.data)));
+      });
+      es.onerror = () => {
+        if (es.readyState === EventSource.CLOSED) {
+          // endpoint inexistente/recusado: usar polling para esta máquina
+          polled.add(m);
+          fetchAgentStatus(m);
+          return;
+        }
+        // reconectando: mantém o último status marcado como desatualizado; o próximo
+        // snapshot o substitui. Só vira offline se a queda passar de STALE_MAX_MS.
+        setAgentStatuses((prev) => {
+          const cur = prev[m._id];
+          const staleSince = cur?.staleSince || Date.now();
+          if (!cur?.data || Date.now() - staleSince > STALE_MAX_MS) {
+            return { ...prev, [m._id]: { loading: false, error: 'Falha ao obter status', data: null } };
+          }
+          return { ...prev, [m._id]: { ...cur, loading: false, stale: true, staleSince } };
+        });
+      };
+    });
     const interval = setInterval(() => {
-      machines.forEach((m) => fetchAgentStatus(m));
+      polled.forEach((m) => fetchAgentStatus(m));
     }, 10000); // 10s
-    return () => clearInterval(interval);
-  }, [machines]);
+    return () => {
+      clearInterval(interval);
+      sources.forEach((es) => es.close());
+    };
+  }, [machineKeys]);
 
   const uploadToAgent = async (machine, file, estilo) => {
     if (!machine?.agentUrl) {
@@ -204,19 +270,33 @@ export default function WallpaperManager() {
     setUploading((prev) => ({ ...prev, [machine._id]: true }));
     const toastId = toast.loading(`Enviando imagem para ${machine.name}...`);
     try {
-      const formData = new FormData();
-      formData.append('file', file);
-      formData.append('estilo', estilo || 'preencher');
-      const res = await fetch(`${machine.agentUrl}/alterar_papel_de_parede`, {
-        method: 'POST',
-        body: formData,
-      });
-      if (!res.ok) {
-        let msg = 'Erro ao alterar papel de parede';
-        try { const err = await res.json(); msg = err.detail || err.message || msg; } catch {}
-        throw new Error(msg);
+      let body;
+      if (file.size > RESUMABLE_MIN_BYTES) {
+        // arquivos grandes: upload em pedaços, retomável se a conexão cair
+        body = await agentService.uploadResumable(machine.agentUrl, file, {
+          estilo: estilo || 'preencher',
+          onProgress: (p) => toast.loading(`Enviando imagem para ${machine.name}... ${Math.round(p * 100)}%`, { id: toastId }),
+        });
+      } else {
+        const formData = new FormData();
+        formData.append('file', file);
+        formData.append('estilo', estilo || 'preencher');
+        const res = await fetch(`${machine.agentUrl}/alterar_papel_de_parede`, {
+          method: 'POST',
+          body: formData,
+        });
+        if (!res.ok) {
+          let msg = 'Erro ao alterar papel de parede';
+          try { const err = await res.json(); msg = err.detail || err.message || msg; } catch {}
+          throw new Error(msg);
+        }
+        body = await res.json().catch(() => ({}));
+      }
+      if (body?.status === 'substituido') {
+        toast.info(`Alteração em ${machine.name} substituída por uma mais recente`, { id: toastId });
+      } else {
+        toast.success(`Papel de parede atualizado em ${machine.name}`, { id: toastId });
       }
-      toast.success(`Papel de parede atualizado em ${machine.name}`, { id: toastId });
       await fetchAgentStatus(machine);
     } catch (e) {
       console.error(e);
@@ -508,6 +588,7 @@ export default function WallpaperManager() {
                   const loading = status?.loading;
                   const data = status?.data;
                   const isOnline = data?.status === 'online';
+                  const isStale = !!status?.stale;
                   const isUploading = !!uploading[m._id];
                   const img = data?.wallpaper?.image_url;
                   const desktopName = data?.desktop || m.name;
@@ -525,8 +606,8 @@ export default function WallpaperManager() {
                       <CardHeader className="py-2 px-3">
                         <CardTitle className="flex items-center justify-between text-sm">
                           <span className="truncate" title={desktopName}>{desktopName}</span>
-                          <span className={`text-[10px] px-1.5 py-0.5 rounded-full ${isOnline ? 'bg-green-100 text-green-700' : 'bg-gray-200 text-gray-700'}`}>
-                            {isOnline ? 'Online' : 'Offline'}
+                          <span className={`text-[10px] px-1.5 py-0.5 rounded-full ${isStale ? 'bg-amber-100 text-amber-700' : isOnline ? 'bg-green-100 text-green-700' : 'bg-gray-200 text-gray-700'}`}>
+                            {isStale ? 'Reconectando' : isOnline ? 'Online' : 'Offline'}
                           </span>
                         </CardTitle>
                         {fileName && (
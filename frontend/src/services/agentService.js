@@ -32,10 +32,76 @@ async function request(path, { method = 'GET', body, xAgentKey } = {}) {
   return data;
 }
 
+const sleep = (ms) => new Promise((r) => setTimeout(r, ms));
+
+// Upload retomável para um agente específico (sessão -> PUT de pedaços com offset -> finalize).
+// Se a conexão cair, consulta o progresso no agente e continua de onde parou.
+async function uploadResumable(agentUrl, file, { estilo, reaproveitarSimilar, xAgentKey, onProgress, retries = 5 } = {}) {
+  const call = async (path, init = {}, params = {}) => {
+    const url = new URL(path, agentUrl);
+    if (xAgentKey) url.searchParams.set('x_agent_key', xAgentKey);
+    Object.entries(params).forEach(([k, v]) => url.searchParams.set(k, String(v)));
+    const resp = await fetch(url.toString(), init);
+    let data = null;
+    try { data = await resp.json(); } catch (_) {}
+    if (!resp.ok) {
+      const err = new Error((data && (data.detail || data.message)) || `HTTP ${resp.status}`);
+      err.status = resp.status;
+      err.body = data;
+      throw err;
+    }
+    return data;
+  };
+
+  let sha256;
+  if (window.crypto?.subtle) {
+    // disponível só em contexto seguro; sem ele o agente apenas calcula o hash
+    const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    sha256 = Array.from(new Uint8Array(digest)).map((b) => b.toString(16).padStart(2, '0')).join('');
+  }
+  const session = await call('/uploads', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ filename: file.name, content_type: file.type, size: file.size, sha256 }),
+  });
+
+  let offset = 0;
+  let failures = 0;
+  while (offset < file.size) {
+    const end = Math.min(offset + session.chunk_size, file.size);
+    try {
+      const r = await call(`/uploads/${session.upload_id}`, { method: 'PUT', body: file.slice(offset, end) }, { offset });
+      offset = r.received;
+      failures = 0;
+      onProgress?.(offset / file.size);
+    } catch (e) {
+      if (e.status && e.status < 500 && e.status !== 409) throw e;
+      if (++failures > retries) throw e;
+      await sleep(1000 * failures);
+      try {
+        offset = (await call(`/uploads/${session.upload_id}`)).received;
+      } catch (_) { /* agente ainda inacessível: tenta de novo no próximo ciclo */ }
+    }
+  }
+
+  const form = new FormData();
+  if (estilo) form.append('estilo', estilo);
+  // aceita uma quase-duplicata já armazenada no agente no lugar de gravar outra cópia
+  if (reaproveitarSimilar) form.append('reaproveitar_similar', 'true');
+  return call(`/uploads/${session.upload_id}/finalize`, { method: 'POST', body: form });
+}
+
 export const agentService = {
+  uploadResumable,
   blockSites: (websites, xAgentKey) => request('/block_sites', { method: 'POST', body: { websites }, xAgentKey }),
   unblockSites: (websites, xAgentKey) => request('/unblock_sites', { method: 'POST', body: { websites }, xAgentKey }),
   getBlockedSites: (xAgentKey) => request(`/blocked_sites${xAgentKey ? `?x_agent_key=${encodeURIComponent(xAgentKey)}` : ''}`),
+  // Agenda local do agente: itens [{ file_id, inicio, estilo }] e ciclo_h opcional para rotação
+  getSchedule: () => request('/agendamento'),
+  setSchedule: (itens, ciclo_h, xAgentKey) => request('/agendamento', { method: 'PUT', body: { itens, ciclo_h }, xAgentKey }),
+  clearSchedule: (xAgentKey) => request('/agendamento', { method: 'DELETE', xAgentKey }),
+  // Uso do GridFS por idade/uso e quanto a limpeza liberaria (cacheado no agente)
+  getStorageReport: (refresh = false) => request(`/storage/report${refresh ? '?refresh=true' : ''}`),
   bootstrap: () => request('/bootstrap'),
   setUser: (user_id, agent_key) => request('/set_user', { method: 'POST', body: { user_id, agent_key } }),
   test: () => request('/test-cors'),